@@ -0,0 +1,262 @@
+"""Incremental reader of the JSON datasets generated by synth.
+
+A dataset is an object of arrays of objects, one array per table
+(users, questions, answers, comments).  Loading it with json.load()
+takes several times its size in memory, so the loaders read the
+records of a table in batches instead:
+
+    dataset = _dataset.Dataset(filename)
+    for batch in dataset.batches("users"):
+        ...
+
+The file is scanned once up front to find (and count) the records of
+every table without decoding them; reading a table then only decodes
+its own records, from any point given by the index of the scan.
+"""
+
+import codecs
+import itertools
+import json
+
+import numpy as np
+
+
+BATCH_SIZE = 1000
+
+# The scan records the byte offset of every INDEX_STEP-th record.
+INDEX_STEP = 1000
+
+CHUNK_SIZE = 1024 * 1024
+
+WHITESPACE = " \t\n\r"
+
+
+class Reader:
+    """Reads the JSON values and punctuation of a file one by one,
+    keeping only what it has not consumed yet in memory."""
+
+    def __init__(self, f, offset=0):
+        f.seek(offset)
+        self.f = f
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        # Byte offset in the file of the start of the buffer.
+        self.offset = offset
+        self.eof = False
+
+    def _fill(self):
+        if self.pos:
+            self.offset += len(self.buf[: self.pos].encode())
+            self.buf = self.buf[self.pos :]
+            self.pos = 0
+        data = self.f.read(CHUNK_SIZE)
+        self.eof = not data
+        self.buf += self.decoder.decode(data, final=self.eof)
+
+    def tell(self):
+        """Byte offset of the current position in the file."""
+        return self.offset + len(self.buf[: self.pos].encode())
+
+    def peek(self):
+        """Return the next character after whitespace, "" at the end."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos : self.pos + 1]
+            self._fill()
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(
+                f"expected one of {chars!r} at byte {self.tell()}, got {char!r}"
+            )
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                # The value goes on in the next chunk.
+                self._fill()
+                continue
+            if end == len(self.buf) and not self.eof:
+                # So might a number.
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def elements(self):
+        """Yield the values of an array from the current position, the
+        start of one of them, to its end."""
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+# What bytes.translate() turns the bytes that matter to the scan into,
+# every other byte becoming 0.
+OPENING, CLOSING, COMMA, QUOTE, BACKSLASH = range(1, 6)
+CLASSES = bytearray(256)
+for chars, cls in [(b"[{", OPENING), (b"]}", CLOSING), (b",", COMMA)]:
+    for char in chars:
+        CLASSES[char] = cls
+CLASSES[ord('"')] = QUOTE
+CLASSES[ord("\\")] = BACKSLASH
+CLASSES = bytes(CLASSES)
+
+
+def scan_array(f, offset, step):
+    """Skip the array at byte *offset* of *f* without decoding it.
+
+    Return the number of its values, the byte offsets of every *step*-th
+    one and the byte offset of the end of the array.  The bytes are only
+    searched for quotes, brackets, braces and commas (which UTF-8 never
+    uses within multibyte characters), those in strings left out.
+    """
+    f.seek(offset)
+    depth = 0
+    in_string = False
+    # Length of the run of backslashes at the end of the previous chunk.
+    backslashes = 0
+    opening = None
+    # Number of values started after the first one, and the offsets of
+    # every step-th value.
+    count = 0
+    starts = []
+
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError(f"unterminated array at byte {offset}")
+        base = f.tell() - len(chunk)
+        classes = np.frombuffer(chunk.translate(CLASSES), dtype=np.uint8)
+        positions = np.flatnonzero(classes)
+        classes = classes[positions]
+
+        if backslashes or b"\\" in chunk:
+            # A quote after an odd number of backslashes is escaped.
+            escaped = np.zeros(len(classes), dtype=bool)
+            after = 0
+            for i in np.flatnonzero(classes == BACKSLASH).tolist():
+                if i and classes[i - 1] == BACKSLASH:
+                    if positions[i - 1] + 1 == positions[i]:
+                        continue
+                # The start of a run of backslashes.
+                run = i
+                while (
+                    run + 1 < len(classes)
+                    and classes[run + 1] == BACKSLASH
+                    and positions[run + 1] == positions[run] + 1
+                ):
+                    run += 1
+                length = run - i + 1
+                if positions[i] == 0:
+                    length += backslashes
+                nxt = run + 1
+                if nxt < len(classes) and positions[nxt] == positions[run] + 1:
+                    escaped[nxt] = length % 2 == 1
+                after = length if positions[run] == len(chunk) - 1 else 0
+            if backslashes and len(classes) and positions[0] == 0:
+                if classes[0] != BACKSLASH:
+                    escaped[0] = backslashes % 2 == 1
+            backslashes = after
+            keep = ~escaped & (classes != BACKSLASH)
+            positions = positions[keep]
+            classes = classes[keep]
+
+        # Leave out what is in strings.
+        quotes = classes == QUOTE
+        inside = (np.cumsum(quotes) - quotes + in_string) % 2 == 1
+        in_string = (in_string + int(quotes.sum())) % 2 == 1
+        outside = ~inside & ~quotes
+        positions = positions[outside]
+        classes = classes[outside]
+
+        deltas = (classes == OPENING).astype(np.int64)
+        deltas -= classes == CLOSING
+        depths = depth + np.cumsum(deltas)
+
+        if opening is None and len(positions):
+            opening = base + int(positions[0])
+        ends = np.flatnonzero(depths == 0)
+        if len(ends):
+            positions = positions[: ends[0] + 1]
+            classes = classes[: ends[0] + 1]
+            depths = depths[: ends[0] + 1]
+        if opening is not None and not starts:
+            starts.append(opening + 1)
+        commas = positions[(classes == COMMA) & (depths == 1)]
+        # The value after the i-th comma is the (count + i + 1)-th.
+        indexed = (count + np.arange(1, len(commas) + 1)) % step == 0
+        starts.extend((base + commas[indexed] + 1).tolist())
+        count += len(commas)
+        if len(ends):
+            end = base + int(positions[-1]) + 1
+            break
+        if len(depths):
+            depth = depths[-1]
+
+    if not count:
+        reader = Reader(f, opening)
+        reader.expect("[")
+        if reader.peek() == "]":
+            return 0, [], end
+    return count + 1, starts, end
+
+
+class Dataset:
+    def __init__(self, filename):
+        self.filename = filename
+        # Byte offsets of every INDEX_STEP-th record of the tables, and
+        # their numbers of records.
+        self.offsets = {}
+        self.counts = {}
+
+        with open(filename, "rb") as f:
+            reader = Reader(f)
+            reader.expect("{")
+            if reader.peek() == "}":
+                return
+            while True:
+                table = reader.value()
+                reader.expect(":")
+                count, offsets, end = scan_array(f, reader.tell(), INDEX_STEP)
+                self.counts[table] = count
+                self.offsets[table] = offsets
+                reader = Reader(f, end)
+                if reader.expect(",}") == "}":
+                    return
+
+    def batches(self, table, batch_size=BATCH_SIZE, start=0, stop=None):
+        """Yield the records of *table* in lists of up to *batch_size*,
+        from the *start*-th (a multiple of INDEX_STEP) to the *stop*-th
+        or the last one."""
+        if start % INDEX_STEP:
+            raise ValueError(f"start must be a multiple of {INDEX_STEP}")
+        count = self.counts[table]
+        stop = count if stop is None else min(stop, count)
+        if start >= stop:
+            return
+        with open(self.filename, "rb") as f:
+            reader = Reader(f, self.offsets[table][start // INDEX_STEP])
+            records = reader.elements()
+            for first in range(start, stop, batch_size):
+                yield list(itertools.islice(records, min(batch_size, stop - first)))
+
+    def records(self, table):
+        for batch in self.batches(table):
+            yield from batch
@@ -1,26 +1,104 @@
 import argparse
 import asyncio
+import itertools
 import json
-import random
+import time
+import uuid
 
 import edgedb
-import progress.bar
+import tqdm
 import uvloop
 
+import _dataset
 
-async def import_data(data: dict):
-    client = edgedb.create_async_client(max_concurrency=32)
-    batch_size = 1000
 
-    users = data["users"]
-    questions = data["questions"]
-    answers = data["answers"]
-    comments = data["comments"]
+# Batches start at BATCH_SIZE records and are resized to take about
+# BATCH_TIME seconds each, within MIN_BATCH_SIZE and MAX_BATCH_SIZE.
+BATCH_SIZE = 1000
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 10000
+BATCH_TIME = 0.5
 
 
+class UUIDs:
+    """The UUIDs of the inserted objects by their ID in the dataset,
+    which numbers the objects of a type from 0; 16 bytes each."""
+
+    def __init__(self, count):
+        self.count = count
+        self.data = bytearray(16 * count)
+
+    def _slice(self, i):
+        # A slice past the end would grow the array rather than fail.
+        if not 0 <= i < self.count:
+            raise IndexError(
+                f"dataset ID {i} is out of range, there are {self.count} objects"
+            )
+        return slice(16 * i, 16 * (i + 1))
+
+    def __setitem__(self, i, value: uuid.UUID):
+        self.data[self._slice(i)] = value.bytes
+
+    def __getitem__(self, i) -> str:
+        data = bytes(self.data[self._slice(i)])
+        if not any(data):
+            raise KeyError(f"no object with dataset ID {i} was inserted")
+        return str(uuid.UUID(bytes=data))
+
+
+async def insert_batches(client, label, query, dataset, key, convert, concurrency):
+    """Insert the records of *key* with *query*, which takes the JSON
+    array of the converted records of a batch as its *key* argument
+    and returns the (dataset ID, UUID) of every object it inserts.
+
+    Up to *concurrency* batches are in flight at a time, each in its
+    own transaction, retried on conflicts with the other batches.
+    Return the UUIDs of the inserted objects.
+    """
+    pbar = tqdm.tqdm(desc=label, total=dataset.counts[key], unit="rows")
+    ids = UUIDs(dataset.counts[key])
+    records = dataset.records(key)
+    batch_size = BATCH_SIZE
+
+    async def insert(batch):
+        nonlocal batch_size
+        data = json.dumps([convert(record) for record in batch])
+        start = time.monotonic()
+        async for tx in client.transaction():
+            async with tx:
+                inserted = await tx.query(query, **{key: data})
+        for synth_id, id in inserted:
+            ids[synth_id] = id
+        duration = time.monotonic() - start
+        # Halfway to the size that would have taken BATCH_TIME, so that
+        # a single slow batch does not throw it off.
+        target = len(batch) * BATCH_TIME / max(duration, 1e-3)
+        batch_size = int(
+            min(max((batch_size + target) / 2, MIN_BATCH_SIZE), MAX_BATCH_SIZE)
+        )
+        pbar.update(len(batch))
+
+    in_flight = set()
+    while batch := list(itertools.islice(records, batch_size)):
+        if len(in_flight) >= concurrency:
+            done, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                task.result()
+        in_flight.add(asyncio.create_task(insert(batch)))
+    await asyncio.gather(*in_flight)
+    pbar.close()
+    return ids
+
+
+async def import_data(dataset: _dataset.Dataset, concurrency: int):
+    client = edgedb.create_async_client(max_concurrency=concurrency)
+    client = client.with_retry_options(edgedb.RetryOptions(attempts=10))
+
     # region Load users
-    users_data = [
-        dict(
+    def user_data(u):
+        return dict(
             _id=u["id"],
             age=u["age"],
             email=u["email"],
@@ -32,203 +110,187 @@ async def import_data(data: dict):
             is_verified=u["is_verified"],
             hashed_password=u["hashed_password"],
         )
-        for u in users
-    ]
 
     users_insert_query = r"""
         WITH users := <json>$users
         FOR user in json_array_unpack(users) UNION (
-            INSERT User {
-                age := <Age>user["age"],
-                email := <str>user["email"],
-                first_name := <str>user["first_name"],
-                last_name := <str>user["last_name"],
-                username := <str>user["username"],
-                is_active := <bool>user["is_active"],
-                is_superuser := <bool>user["is_superuser"],
-                is_verified := <bool>user["is_verified"],
-                hashed_password := <str>user["hashed_password"],
-            }
+            WITH inserted := (
+                INSERT User {
+                    age := <Age>user["age"],
+                    email := <str>user["email"],
+                    first_name := <str>user["first_name"],
+                    last_name := <str>user["last_name"],
+                    username := <str>user["username"],
+                    is_active := <bool>user["is_active"],
+                    is_superuser := <bool>user["is_superuser"],
+                    is_verified := <bool>user["is_verified"],
+                    hashed_password := <str>user["hashed_password"],
+                }
+            )
+            SELECT (<int64>user["_id"], inserted.id)
         );
     """
 
-    start = 0
-    users_bar = progress.bar.Bar("Users", max=len(users))
-    users_slice = users_data[start : start + batch_size]
-    while len(users_slice):
-        users_bar.goto(start)
-        await client.query(users_insert_query, users=json.dumps(users_slice))
-        start += batch_size
-        users_slice = users_data[start : start + batch_size]
-    users_bar.goto(users_bar.max)
-    users_bar.finish()
-
-    # Get all users id's
-    user_ids = await client.query_json("SELECT User")
-    user_ids = json.loads(user_ids)
+    user_ids = await insert_batches(
+        client,
+        "Users",
+        users_insert_query,
+        dataset,
+        "users",
+        user_data,
+        concurrency,
+    )
 
     # endregion
 
     # region Load comments
-    comments_data = [
-        dict(
+    def comment_data(c):
+        return dict(
             _id=c["id"],
             upvote=c["upvote"],
             downvote=c["downvote"],
             content=c["content"],
-            author=user_ids[c["author"]]["id"],
+            author=user_ids[c["author"]],
         )
-        for c in comments
-    ]
 
     comments_insert_query = r"""
     WITH comments := <json>$comments
     FOR comment in json_array_unpack(comments) UNION (
-        INSERT Comment {
-            upvote := <int16>comment["upvote"],
-            downvote := <int16>comment["downvote"],
-            content := <str>comment["content"],
-            author := (SELECT User FILTER .id = <uuid>comment["author"])
-        }
+        WITH inserted := (
+            INSERT Comment {
+                upvote := <int16>comment["upvote"],
+                downvote := <int16>comment["downvote"],
+                content := <str>comment["content"],
+                author := (SELECT User FILTER .id = <uuid>comment["author"])
+            }
+        )
+        SELECT (<int64>comment["_id"], inserted.id)
     );
     """
 
-    start = 0
-    comments_bar = progress.bar.Bar("Comments", max=len(comments))
-    comments_slice = comments_data[start : start + batch_size]
-    while len(comments_slice):
-        comments_bar.goto(start)
-        await client.query(comments_insert_query, comments=json.dumps(comments_slice))
-        start += batch_size
-        comments_slice = comments_data[start : start + batch_size]
-    comments_bar.goto(comments_bar.max)
-    comments_bar.finish()
-
-    # Get all comments id's
-    comment_ids = await client.query_json("SELECT Comment")
-    comment_ids = json.loads(comment_ids)
+    comment_ids = await insert_batches(
+        client,
+        "Comments",
+        comments_insert_query,
+        dataset,
+        "comments",
+        comment_data,
+        concurrency,
+    )
     # endregion
 
     # region Load answer
-    random.shuffle(user_ids)
-
-    answers_data = [
-        dict(
+    def answer_data(a):
+        return dict(
             _id=a["id"],
             upvote=a["upvote"],
             downvote=a["downvote"],
             content=a["content"],
             is_accepted=a["is_accepted"],
-            author=user_ids[a["author"]]["id"],
-            comments=[comment_ids[comment]["id"] for comment in a["comments"]],
+            author=user_ids[a["author"]],
+            comments=[comment_ids[comment] for comment in a["comments"]],
         )
-        for a in answers
-    ]
 
     answers_insert_query = r"""
     WITH answers := <json>$answers
     FOR answer IN json_array_unpack(answers) UNION (
-        INSERT Answer {
-            upvote := <int16>answer["upvote"],
-            downvote := <int16>answer["downvote"],
-            content := <str>answer["content"],
-            author := (SELECT User FILTER .id = <uuid>answer["author"]),
-            comments := (
-                FOR x IN {
-                    enumerate(array_unpack(<array<uuid>>answer["comments"]))
-                } UNION (
-                    SELECT Comment FILTER .id = x.1
+        WITH inserted := (
+            INSERT Answer {
+                upvote := <int16>answer["upvote"],
+                downvote := <int16>answer["downvote"],
+                content := <str>answer["content"],
+                author := (SELECT User FILTER .id = <uuid>answer["author"]),
+                comments := (
+                    FOR x IN {
+                        enumerate(array_unpack(<array<uuid>>answer["comments"]))
+                    } UNION (
+                        SELECT Comment FILTER .id = x.1
+                    )
                 )
-            )
-        }
+            }
+        )
+        SELECT (<int64>answer["_id"], inserted.id)
     );
     """
 
-    start = 0
-    answers_bar = progress.bar.Bar("Answers", max=len(answers))
-    answers_slice = answers_data[start : start + batch_size]
-    while len(answers_slice):
-        answers_bar.goto(start)
-        await client.query(answers_insert_query, answers=json.dumps(answers_slice))
-        start += batch_size
-        answers_slice = answers_data[start : start + batch_size]
-    answers_bar.goto(answers_bar.max)
-    answers_bar.finish()
-
-    # Get all answers id's
-    answer_ids = await client.query_json("SELECT Answer")
-    answer_ids = json.loads(answer_ids)
+    answer_ids = await insert_batches(
+        client,
+        "Answers",
+        answers_insert_query,
+        dataset,
+        "answers",
+        answer_data,
+        concurrency,
+    )
     # endregion
 
     # region Load questions
-    random.shuffle(user_ids)
-    random.shuffle(comment_ids)
-
-    questions_data = [
-        dict(
+    def question_data(q):
+        return dict(
             _id=q["id"],
             upvote=q["upvote"],
             downvote=q["downvote"],
             content=q["content"],
             tags=q["tags"],
             title=q["title"],
-            author=user_ids[q["author"]]["id"],
-            comments=[comment_ids[comment]["id"] for comment in q["comments"]],
-            answers=[answer_ids[answer]["id"] for answer in q["answers"]],
+            author=user_ids[q["author"]],
+            comments=[comment_ids[comment] for comment in q["comments"]],
+            answers=[answer_ids[answer] for answer in q["answers"]],
         )
-        for q in questions
-    ]
 
     questions_insert_query = r"""
     WITH questions := <json>$questions
     FOR question in json_array_unpack(questions) UNION (
-        INSERT Question {
-            upvote := <int16>question["upvote"],
-            downvote := <int16>question["downvote"],
-            content := <str>question["content"],
-            tags := <array<str>>question["tags"],
-            title := <str>question["title"],
-            author := (SELECT User FILTER .id = <uuid>question["author"]),
-            comments := (
-                FOR x IN {
-                    enumerate(array_unpack(<array<uuid>>question["comments"]))
-                } UNION (
-                    SELECT Comment FILTER .id = x.1
-                )
-            ),
-            answers := (
-                FOR x IN {
-                    enumerate(array_unpack(<array<uuid>>question["answers"]))
-                } UNION (
-                    SELECT Answer FILTER .id = x.1
+        WITH inserted := (
+            INSERT Question {
+                upvote := <int16>question["upvote"],
+                downvote := <int16>question["downvote"],
+                content := <str>question["content"],
+                tags := <array<str>>question["tags"],
+                title := <str>question["title"],
+                author := (SELECT User FILTER .id = <uuid>question["author"]),
+                comments := (
+                    FOR x IN {
+                        enumerate(array_unpack(<array<uuid>>question["comments"]))
+                    } UNION (
+                        SELECT Comment FILTER .id = x.1
+                    )
+                ),
+                answers := (
+                    FOR x IN {
+                        enumerate(array_unpack(<array<uuid>>question["answers"]))
+                    } UNION (
+                        SELECT Answer FILTER .id = x.1
+                    )
                 )
-            )
-        }
+            }
+        )
+        SELECT (<int64>question["_id"], inserted.id)
     );
     """
 
-    start = 0
-    questions_bar = progress.bar.Bar("Questions", max=len(questions))
-    questions_slice = questions_data[start : start + batch_size]
-    while len(questions_slice):
-        questions_bar.goto(start)
-        await client.query(
-            questions_insert_query, questions=json.dumps(questions_slice)
-        )
-        start += batch_size
-        questions_slice = questions_data[start : start + batch_size]
-    questions_bar.goto(questions_bar.max)
-    questions_bar.finish()
+    await insert_batches(
+        client,
+        "Questions",
+        questions_insert_query,
+        dataset,
+        "questions",
+        question_data,
+        concurrency,
+    )
     # endregion
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("filename", type=str, help="The EdgeDB JSON dataset file")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Number of batches to insert at the same time",
+    )
     args = parser.parse_args()
 
-    with open(args.filename) as f:
-        data = json.load(f)
-
     uvloop.install()
-    asyncio.run(import_data(data))
+    asyncio.run(import_data(_dataset.Dataset(args.filename), args.concurrency))
@@ -56,4 +56,19 @@ UPDATE_COMMENTS_ON_ANSWER = """
         id,
         comments,
     }
-"""
\ No newline at end of file
+"""
+
+# The lowest and the highest ID of an object type, and the first IDs
+# from random pivots, to sample objects without sorting whole types.
+ID_BOUNDS = """
+    SELECT (
+        lo := (SELECT {type} ORDER BY .id LIMIT 1).id,
+        hi := (SELECT {type} ORDER BY .id DESC LIMIT 1).id,
+    )
+"""
+
+SAMPLE_IDS = """
+    FOR pivot IN array_unpack(<array<uuid>>$pivots) UNION (
+        SELECT {type} FILTER .id >= pivot ORDER BY .id LIMIT 1
+    ).id
+"""
@@ -1,6 +1,16 @@
+import asyncio
+import collections
 import edgedb
+import edgedb.credentials
+import json
+import os
 import random
 import threading
+import time
+import uuid
+
+import _idcache
+import _instrument
 
 from . import queries
 
@@ -8,12 +18,84 @@ ASYNC = True
 INSERT_PREFIX = 'insert_test__'
 thread_data = threading.local()
 
+# Dump of the dataset, restored to reset the database.
+SNAPSHOT_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    '.snapshots', 'edgedb.dump')
+
+# The instance that `make load-edgedb` links the project to, used when
+# EDGEDB_INSTANCE does not name another one.
+INSTANCE = 'edgedb_bench'
+
+write_isolation = 'none'
+# With bulk-delete isolation, the IDs of the inserted users, and of the
+# answers that got new comments.
+inserted = collections.defaultdict(set)
+
+
+class Rollback(Exception):
+    """Leaves a transaction, rolling it back, with the result of the
+    query made in it."""
+
+
+def init(ctx):
+    global write_isolation
+    write_isolation = ctx.write_isolation
+
+
+def instance_credentials():
+    instance = os.environ.get('EDGEDB_INSTANCE', INSTANCE)
+    path = edgedb.credentials.get_credentials_path(instance)
+    try:
+        return edgedb.credentials.read_credentials(path)
+    except (OSError, ValueError) as e:
+        raise RuntimeError(
+            f'could not read the credentials of the EdgeDB instance '
+            f'{instance!r} from {path} ({e}), set EDGEDB_INSTANCE to the '
+            f'instance of the project') from None
+
+
+def net_target(ctx):
+    """The address the network proxy forwards EdgeDB connections to:
+    --edgedb-port on --db-host, or else the instance of the project."""
+    if ctx.edgedb_port:
+        return ctx.db_host, ctx.edgedb_port
+    credentials = instance_credentials()
+    if not credentials.get('port'):
+        raise RuntimeError(
+            'the network proxy needs the EdgeDB server port, pass '
+            '--edgedb-port')
+    return credentials.get('host') or 'localhost', credentials['port']
+
+
+def connect_args(ctx):
+    if not ctx.net_proxy:
+        # Connect to the instance of the project directly.
+        return {}
+
+    if not ctx.edgedb_port:
+        raise RuntimeError(
+            'the network proxy is not forwarding EdgeDB connections, pass '
+            '--edgedb-port')
+    # Connections go through the network proxy, which the credentials
+    # of the instance know nothing about.
+    credentials = instance_credentials()
+    return dict(
+        host=ctx.db_host,
+        port=ctx.edgedb_port,
+        user=credentials['user'],
+        password=credentials.get('password'),
+        database=credentials.get('database'),
+        tls_security='insecure',
+    )
+
 
 async def connect(ctx):
     client = getattr(thread_data, 'client', None)
     if client is None:
         client = (
-            edgedb.create_async_client(max_concurrency=ctx.concurrency)
+            edgedb.create_async_client(
+                max_concurrency=ctx.concurrency, **connect_args(ctx))
             .with_retry_options(
                 edgedb.RetryOptions(attempts=10)
             )
@@ -23,80 +105,215 @@ async def connect(ctx):
 
 
 async def close(ctx, conn):
-    # Don't bother closing individual pool connections, they'll be
-    # closed automatically.
-    pass
+    # Every connection is a client of its own, whose connections would
+    # otherwise only be closed on exit, keeping the database busy (see
+    # restore_snapshot()).
+    await conn.aclose()
+
+
+async def edgedb_cli(*args):
+    proc = await asyncio.create_subprocess_exec(
+        'edgedb', *args, stdout=asyncio.subprocess.DEVNULL)
+    if await proc.wait() != 0:
+        raise RuntimeError(f'`edgedb {" ".join(args)}` failed')
+
+
+async def save_snapshot(ctx):
+    os.makedirs(os.path.dirname(SNAPSHOT_FILE), exist_ok=True)
+    if os.path.exists(SNAPSHOT_FILE):
+        os.unlink(SNAPSHOT_FILE)
+    await edgedb_cli('dump', SNAPSHOT_FILE)
+
+
+async def restore_snapshot(ctx):
+    if not os.path.exists(SNAPSHOT_FILE):
+        raise RuntimeError(
+            'there is no snapshot of the EdgeDB database, run '
+            '`python snapshot.py save` after loading the dataset')
+    # A dump is restored into an empty database, which like in
+    # `make load-edgedb` is recreated from another one.
+    await edgedb_cli('query', 'CREATE DATABASE temp')
+    await edgedb_cli('-d', 'temp', 'query', 'DROP DATABASE edgedb')
+    await edgedb_cli('-d', 'temp', 'query', 'CREATE DATABASE edgedb')
+    await edgedb_cli('query', 'DROP DATABASE temp')
+    await edgedb_cli('restore', SNAPSHOT_FILE)
+
+
+# Sampled objects of every type, see queries.SAMPLE_IDS.
+ID_TYPES = ('User', 'Question', 'Answer', 'Comment')
+
+# Extra pivots drawn for those landing on IDs that were already found.
+OVERSAMPLING = 1.25
+
+
+async def sample_ids(conn, type_name, n, rng):
+    bounds = await conn.query_single(
+        queries.ID_BOUNDS.format(type=type_name))
+    if bounds.lo is None:
+        return []
+
+    # Every pivot picks the first ID after it, so IDs after larger gaps
+    # are a bit more likely, which is close enough for random UUIDs.
+    ids = set()
+    while len(ids) < n:
+        pivots = [
+            uuid.UUID(int=rng.randint(bounds.lo.int, bounds.hi.int))
+            for _ in range(round((n - len(ids)) * OVERSAMPLING) + 1)
+        ]
+        found = await conn.query(
+            queries.SAMPLE_IDS.format(type=type_name), pivots=pivots)
+        if not set(found) - ids:
+            # Every object of the type was found.
+            break
+        ids.update(found)
+
+    # The order of the result is up to the server.
+    ids = sorted(ids)
+    rng.shuffle(ids)
+    return ids[:n]
 
 
 async def load_ids(ctx, conn):
-    d = await conn.query_single(
-        """
-        WITH
-            U := User {id, r := random()},
-            C := Comment {id, r := random()},
-            A := Answer {id, r := random()},
-            Q := Question {id, r := random()}
-        SELECT (
-            users := array_agg((SELECT U ORDER BY U.r LIMIT <int64>$limit).id),
-            comments := array_agg((SELECT C ORDER BY C.r LIMIT <int64>$limit).id),
-            answers := array_agg((SELECT A ORDER BY A.r LIMIT <int64>$limit).id),
-            questions := array_agg((SELECT Q ORDER BY Q.r LIMIT <int64>$limit).id),
-        );
-    """,
-        limit=ctx.number_of_ids,
-    )
+    async def fingerprint():
+        return [
+            (type_name, *await conn.query_single(
+                queries.ID_BOUNDS.format(type=type_name)))
+            for type_name in ID_TYPES
+        ]
+
+    async def sample(rng):
+        return {
+            type_name: await sample_ids(
+                conn, type_name, ctx.number_of_ids, rng)
+            for type_name in ID_TYPES
+        }
+
+    d = await _idcache.load_pools(ctx, 'edgedb', await fingerprint(), sample)
 
     return dict(
-        get_answer=list(d.answers),
-        get_comments_on_question=list(d.questions),
+        get_answer=d['Answer'],
+        get_comments_on_question=d['Question'],
         # generate as many insert stubs as "concurrency" to
         # accommodate concurrent inserts
         insert_user=[INSERT_PREFIX] * ctx.concurrency,
         update_comments_on_answer=[
             {
                 "prefix": INSERT_PREFIX,
-                "answer_id": list(d.answers),
-                "author_id": list(d.users),
+                "answer_id": d['Answer'],
+                "author_id": d['User'],
             }
         ] * ctx.concurrency,
     )
 
 
+async def write(conn, query, args):
+    if write_isolation != 'rollback':
+        with _instrument.phase(_instrument.WAIT):
+            return await conn.query_single_json(query, **args)
+
+    # Starting and rolling back the transaction are isolation, the
+    # query made in it is waiting as usual.
+    start = time.monotonic_ns()
+    wait = 0
+    try:
+        async for tx in conn.transaction():
+            async with tx:
+                sent = time.monotonic_ns()
+                result = await tx.query_single_json(query, **args)
+                wait += time.monotonic_ns() - sent
+                raise Rollback(result)
+    except Rollback as e:
+        return e.args[0]
+    finally:
+        _instrument.record(_instrument.WAIT, wait)
+        _instrument.record(
+            _instrument.ISOLATION, time.monotonic_ns() - start - wait)
+
+
+# The server returns JSON, so there is nothing to post-process.
+
 async def get_answer(conn, id):
-    return await conn.query_single_json(queries.GET_ANSWER, id=id)
+    with _instrument.phase(_instrument.WAIT):
+        return await conn.query_single_json(queries.GET_ANSWER, id=id)
 
 
 async def get_comments_on_question(conn, id):
-    return await conn.query_json(queries.GET_COMMENTS_ON_QUESTION, id=id)
+    with _instrument.phase(_instrument.WAIT):
+        return await conn.query_json(queries.GET_COMMENTS_ON_QUESTION, id=id)
 
 
 async def insert_user(conn, val):
-    num = random.randrange(10, 100)
-    return await conn.query_single_json(
-        queries.INSERT_USER,
-        age=num,
-        email=f"{val}{num}@test.com",
-        fname=f"{val}{num+1}",
-        lname=f"{val}{num+2}",
-        username=f"{val}{num+3}",
-        hashed_password=f"{val}{num+4}",
-    )
+    with _instrument.phase(_instrument.ENCODE):
+        num = random.randrange(10, 100)
+        args = dict(
+            age=num,
+            email=f"{val}{num}@test.com",
+            fname=f"{val}{num+1}",
+            lname=f"{val}{num+2}",
+            username=f"{val}{num+3}",
+            hashed_password=f"{val}{num+4}",
+        )
+    result = await write(conn, queries.INSERT_USER, args)
+    if write_isolation == 'bulk-delete':
+        with _instrument.phase(_instrument.ISOLATION):
+            inserted['insert_user'].add(json.loads(result)['id'])
+    return result
 
 
 async def update_comments_on_answer(conn, val):
-    num = random.randrange(10_000)
-    return await conn.query_single_json(
-        queries.UPDATE_COMMENTS_ON_ANSWER,
-        answer_id=random.choice(val["answer_id"]),
-        author_id=random.choice(val["author_id"]),
-        upvote=num,
-        downvote=num // 10,
-        content=f"{val['prefix']}{num}",
-    )
+    with _instrument.phase(_instrument.ENCODE):
+        num = random.randrange(10_000)
+        args = dict(
+            answer_id=random.choice(val["answer_id"]),
+            author_id=random.choice(val["author_id"]),
+            upvote=num,
+            downvote=num // 10,
+            content=f"{val['prefix']}{num}",
+        )
+    result = await write(conn, queries.UPDATE_COMMENTS_ON_ANSWER, args)
+    if write_isolation == 'bulk-delete':
+        with _instrument.phase(_instrument.ISOLATION):
+            inserted['update_comments_on_answer'].add(args['answer_id'])
+    return result
 
 
 async def cleanup(ctx, conn, queryname):
-    if queryname == "insert_user":
+    if write_isolation == 'rollback':
+        # Nothing was left behind.
+        return
+    elif write_isolation == 'bulk-delete':
+        ids = inserted.pop(queryname, None)
+        if not ids:
+            return
+        ids = [uuid.UUID(str(i)) for i in ids]
+        if queryname == 'insert_user':
+            await conn.query("""
+                DELETE User FILTER .id IN array_unpack(<array<uuid>>$ids)
+            """, ids=ids)
+        else:
+            # Only look for the new comments among those of the answers
+            # that got some.
+            comments = await conn.query("""
+                SELECT (
+                    SELECT Answer
+                    FILTER .id IN array_unpack(<array<uuid>>$ids)
+                ).comments FILTER .content LIKE <str>$prefix
+            """, ids=ids, prefix=f"{INSERT_PREFIX}%")
+            comments = [uuid.UUID(str(c.id)) for c in comments]
+            await conn.query("""
+                UPDATE Answer FILTER .id IN array_unpack(<array<uuid>>$ids)
+                SET {
+                    comments -= (
+                        SELECT Comment
+                        FILTER .id IN array_unpack(<array<uuid>>$comments)
+                    )
+                }
+            """, ids=ids, comments=comments)
+            await conn.query("""
+                DELETE Comment
+                FILTER .id IN array_unpack(<array<uuid>>$comments)
+            """, comments=comments)
+    elif queryname == "insert_user":
         # Delete the inserted user data
         await conn.query("""
             DELETE User
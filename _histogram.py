@@ -0,0 +1,182 @@
+import math
+
+
+class Histogram:
+    """A compact, mergeable HDR-style histogram of latencies.
+
+    Values (in nanoseconds) are counted in power-of-two buckets, each
+    split into linear sub-buckets, so that every recorded value is kept
+    within ``10 ** -significant_digits`` relative precision.  Only
+    non-empty buckets are stored and there is no upper limit on the
+    recordable value.
+    """
+
+    def __init__(self, significant_digits=3, resolution=1):
+        if not 1 <= significant_digits <= 5:
+            raise ValueError('significant_digits must be in [1, 5]')
+        if resolution < 1:
+            raise ValueError('resolution must be at least 1ns')
+
+        self.significant_digits = significant_digits
+        self.resolution = resolution
+
+        self._unit_magnitude = int(math.log2(resolution))
+        largest_single_unit = 2 * 10 ** significant_digits
+        self._sub_bucket_count_magnitude = math.ceil(
+            math.log2(largest_single_unit))
+        self._sub_bucket_half_count_magnitude = \
+            self._sub_bucket_count_magnitude - 1
+        self._sub_bucket_half_count = \
+            1 << self._sub_bucket_half_count_magnitude
+        self._sub_bucket_mask = (
+            ((1 << self._sub_bucket_count_magnitude) - 1)
+            << self._unit_magnitude
+        )
+
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        bucket = (
+            (value | self._sub_bucket_mask).bit_length()
+            - self._unit_magnitude
+            - self._sub_bucket_half_count_magnitude
+            - 1
+        )
+        sub_bucket = value >> (bucket + self._unit_magnitude)
+        return (
+            ((bucket + 1) << self._sub_bucket_half_count_magnitude)
+            + sub_bucket - self._sub_bucket_half_count
+        )
+
+    def _bucket_range(self, index):
+        bucket = (index >> self._sub_bucket_half_count_magnitude) - 1
+        sub_bucket = (
+            (index & (self._sub_bucket_half_count - 1))
+            + self._sub_bucket_half_count
+        )
+        if bucket < 0:
+            sub_bucket -= self._sub_bucket_half_count
+            bucket = 0
+        shift = bucket + self._unit_magnitude
+        return sub_bucket << shift, 1 << shift
+
+    def lowest_equivalent(self, index):
+        return self._bucket_range(index)[0]
+
+    def highest_equivalent(self, index):
+        low, size = self._bucket_range(index)
+        return low + size - 1
+
+    def median_equivalent(self, index):
+        low, size = self._bucket_range(index)
+        return low + size // 2
+
+    def record(self, value, count=1):
+        value = int(value)
+        if value < 0:
+            value = 0
+
+        idx = self._index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + count
+        self.total += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _check_compatible(self, other):
+        if (self.significant_digits != other.significant_digits
+                or self.resolution != other.resolution):
+            raise ValueError(
+                'cannot merge histograms with different precision')
+
+    def merge(self, other):
+        self._check_compatible(other)
+        counts = self.counts
+        for idx, count in other.counts.items():
+            counts[idx] = counts.get(idx, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None and (self.min is None
+                                      or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None
+                                      or other.max > self.max):
+            self.max = other.max
+        return self
+
+    def copy(self):
+        return Histogram(
+            self.significant_digits, self.resolution).merge(self)
+
+    def buckets(self):
+        """Return ``(median_value, count)`` of all non-empty buckets."""
+        return [
+            (self.median_equivalent(idx), self.counts[idx])
+            for idx in sorted(self.counts)
+        ]
+
+    def mean(self):
+        if not self.total:
+            return 0.0
+        return self.sum / self.total
+
+    def stddev(self):
+        if not self.total:
+            return 0.0
+        mean = self.mean()
+        variance = sum(
+            (value - mean) ** 2 * count for value, count in self.buckets()
+        ) / self.total
+        return math.sqrt(variance)
+
+    def percentiles(self, percentiles):
+        """Return the values at the given percentiles (in [0, 100])."""
+        if not self.total:
+            return [0] * len(percentiles)
+
+        targets = sorted(
+            (max(math.ceil(p / 100 * self.total), 1), i)
+            for i, p in enumerate(percentiles)
+        )
+        result = [0] * len(percentiles)
+        seen = 0
+        t = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            while t < len(targets) and targets[t][0] <= seen:
+                value = self.highest_equivalent(idx)
+                result[targets[t][1]] = max(min(value, self.max), self.min)
+                t += 1
+            if t == len(targets):
+                break
+        return result
+
+    def value_at_percentile(self, percentile):
+        return self.percentiles([percentile])[0]
+
+    def to_dict(self):
+        return {
+            'significant_digits': self.significant_digits,
+            'resolution': self.resolution,
+            'total': self.total,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'counts': [[idx, self.counts[idx]] for idx in sorted(self.counts)],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls(data['significant_digits'], data['resolution'])
+        hist.counts = {idx: count for idx, count in data['counts']}
+        hist.total = data['total']
+        hist.sum = data['sum']
+        hist.min = data['min']
+        hist.max = data['max']
+        return hist
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import os.path
+import random
+import uuid
+
+import numpy as np
+
+
+def cache_path(ctx, name, fingerprint):
+    digest = hashlib.sha1(
+        json.dumps(fingerprint, default=str).encode()).hexdigest()[:16]
+    return os.path.join(
+        ctx.ids_cache,
+        f'{name}-{digest}-n{ctx.number_of_ids}-s{ctx.seed}.npz')
+
+
+def _encode(ids):
+    if ids and not isinstance(ids[0], int):
+        data = b''.join(i.bytes for i in ids)
+        return np.frombuffer(data, dtype=np.uint8).reshape(-1, 16), 'uuid'
+    return np.array(ids, dtype=np.int64), 'int'
+
+
+def _decode(array, kind):
+    if kind == 'uuid':
+        data = array.tobytes()
+        return [
+            uuid.UUID(bytes=data[i:i + 16]) for i in range(0, len(data), 16)
+        ]
+    return array.tolist()
+
+
+def save(filename, pools):
+    arrays = {}
+    kinds = {}
+    for name, ids in pools.items():
+        arrays[name], kinds[name] = _encode(ids)
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    # Write the file under its final name only once it is complete.
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, __kinds__=np.array(json.dumps(kinds)), **arrays)
+    os.replace(tmp, filename)
+
+
+def load(filename):
+    with np.load(filename) as data:
+        kinds = json.loads(str(data['__kinds__']))
+        return {
+            name: _decode(data[name], kind) for name, kind in kinds.items()
+        }
+
+
+async def load_pools(ctx, name, fingerprint, sample):
+    """Return the ID pools of a dataset.
+
+    *sample* is a coroutine function drawing the pools (a dict of lists
+    of int or UUID IDs) with a random.Random.  Pools are cached in
+    --ids-cache, by implementation *name*, dataset *fingerprint*,
+    --number-of-ids and --seed, so that later runs on the same data use
+    the same IDs without sampling again.
+    """
+    if not ctx.ids_cache:
+        return await sample(random.Random(ctx.seed))
+
+    filename = cache_path(ctx, name, fingerprint)
+    try:
+        return load(filename)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    pools = await sample(random.Random(ctx.seed))
+    save(filename, pools)
+    return pools
@@ -0,0 +1,73 @@
+"""Phases of the requests made by the query implementations.
+
+Query methods mark the parts of a request with the phase() context
+manager (or report a duration with record()), so that the time spent
+in the database and on the wire can be told apart from the time spent
+in Python:
+
+    with _instrument.phase(_instrument.ENCODE):
+        query = build_query(id)
+    with _instrument.phase(_instrument.WAIT):
+        rows = await conn.fetch(query)
+    with _instrument.phase(_instrument.POSTPROCESS):
+        return json.dumps(to_dict(rows))
+
+Phases are only recorded while the harness collects them (see
+collect()); otherwise marking them costs next to nothing.  The time of
+a request outside all marked phases is reported as OTHER.
+"""
+
+import contextlib
+import contextvars
+import time
+
+
+# Building the query and its arguments.
+ENCODE = 'encode'
+# Sending the query and waiting for the result: network, server and the
+# driver's protocol handling.
+WAIT = 'wait'
+# Turning the rows returned by the driver into Python objects.
+DECODE = 'decode'
+# Post-processing in Python, e.g. building and serializing the result.
+POSTPROCESS = 'postprocess'
+# Keeping writes from changing the dataset (see --write-isolation), e.g.
+# starting and rolling back a transaction.
+ISOLATION = 'isolation'
+# The rest of the request.
+OTHER = 'other'
+
+_durations = contextvars.ContextVar('_durations', default=None)
+
+
+def collect():
+    """Collect the phases of the requests made in the current context.
+
+    Returns a dict of phase names to durations in nanoseconds, which the
+    caller clears before every request.
+    """
+    durations = {}
+    _durations.set(durations)
+    return durations
+
+
+def record(name, duration):
+    """Add *duration* (in nanoseconds) to the phase *name*."""
+    durations = _durations.get()
+    if durations is not None:
+        durations[name] = durations.get(name, 0) + duration
+
+
+@contextlib.contextmanager
+def phase(name):
+    durations = _durations.get()
+    if durations is None:
+        yield
+        return
+
+    start = time.monotonic_ns()
+    try:
+        yield
+    finally:
+        durations[name] = (
+            durations.get(name, 0) + time.monotonic_ns() - start)
@@ -0,0 +1,96 @@
+import functools
+
+import numpy as np
+
+
+# Cycle through the IDs in random order, every connection with IDs of
+# its own (the historical behaviour).
+SHUFFLE = 'shuffle'
+UNIFORM = 'uniform'
+ZIPF = 'zipf'
+HOTSPOT = 'hotspot'
+SEQUENTIAL = 'sequential'
+
+DISTRIBUTIONS = (SHUFFLE, UNIFORM, ZIPF, HOTSPOT, SEQUENTIAL)
+
+# Number of keys drawn at once; drawing them one at a time would cost
+# more than the queries of the fastest implementations.
+BATCH_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def zipf_cdf(nkeys, s):
+    """Cumulative probabilities of the ranks of a Zipf distribution over
+    *nkeys* keys, shared by all the connections of a process."""
+    weights = np.arange(1, nkeys + 1, dtype=np.float64) ** -s
+    cdf = np.cumsum(weights)
+    cdf /= cdf[-1]
+    return cdf
+
+
+class KeyChooser:
+    """Picks keys out of *values* following a skewed (or not) access
+    distribution.
+
+    The keys are ranked by their position in *values*: with zipf the
+    first key is the most popular one, with hotspot the first
+    *hot_keys* (a fraction) get *hot_traffic* (a fraction) of the
+    requests.  Sequential walks the sorted keys, starting anywhere.
+    Keys are sampled in batches with NumPy, so picking one is a list
+    lookup, even for pools of millions of keys.
+    """
+
+    def __init__(self, values, distribution, *, zipf_s=1.0, hot_keys=0.2,
+                 hot_traffic=0.8, rng=None):
+        if distribution not in (UNIFORM, ZIPF, HOTSPOT, SEQUENTIAL):
+            raise ValueError(f'unknown key distribution: {distribution!r}')
+        if distribution == SEQUENTIAL:
+            values = sorted(values)
+        self.values = values
+        self.distribution = distribution
+        self.zipf_s = zipf_s
+        self.nhot = min(max(round(len(values) * hot_keys), 1), len(values))
+        self.hot_traffic = hot_traffic
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.batch = []
+        self.i = 0
+        self.next_key = int(self.rng.integers(len(values)))
+
+    def _sample(self, n):
+        nkeys = len(self.values)
+        if self.distribution == UNIFORM:
+            return self.rng.integers(nkeys, size=n)
+        elif self.distribution == ZIPF:
+            cdf = zipf_cdf(nkeys, self.zipf_s)
+            return np.searchsorted(cdf, self.rng.random(n), side='right')
+        elif self.distribution == HOTSPOT:
+            if self.nhot == nkeys:
+                return self.rng.integers(nkeys, size=n)
+            hot = self.rng.random(n) < self.hot_traffic
+            return np.where(
+                hot,
+                self.rng.integers(self.nhot, size=n),
+                self.rng.integers(self.nhot, nkeys, size=n),
+            )
+        else:
+            keys = (np.arange(n) + self.next_key) % nkeys
+            self.next_key = int(keys[-1] + 1) % nkeys
+            return keys
+
+    def get_next(self):
+        if self.i == len(self.batch):
+            self.batch = self._sample(BATCH_SIZE).tolist()
+            self.i = 0
+        key = self.batch[self.i]
+        self.i += 1
+        return self.values[key]
+
+
+def describe(ctx):
+    """The key distribution of a run, as recorded in the results."""
+    params = dict(distribution=ctx.key_dist, number_of_ids=ctx.number_of_ids)
+    if ctx.key_dist == ZIPF:
+        params.update(zipf_s=ctx.zipf_s)
+    elif ctx.key_dist == HOTSPOT:
+        params.update(hot_keys=ctx.hot_keys, hot_traffic=ctx.hot_traffic)
+    return params
@@ -0,0 +1,203 @@
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import random
+import time
+import typing
+
+import uvloop
+
+
+DISTRIBUTIONS = ('constant', 'uniform', 'normal', 'pareto')
+
+# Size of the chunks read from the sockets; every chunk is delayed on
+# its own, which for the small messages of database protocols is close
+# to a delay per packet.
+CHUNK_SIZE = 64 * 1024
+
+# Number of chunks in flight in one direction of a connection before
+# the proxy stops reading from the sender.
+QUEUE_SIZE = 256
+
+PARETO_SHAPE = 3.0
+
+# How early the timers of the event loop may fire, and how late a
+# sleeping thread may wake up, in seconds.
+TIMER_RESOLUTION = 0.002
+SLEEP_SLACK = 0.0005
+
+# Number of threads finishing the delays of the chunks: one per chunk
+# due within TIMER_RESOLUTION, so it bounds the chunks in flight that
+# are delivered on time.
+SLEEPERS = 256
+
+
+class NetConfig(typing.NamedTuple):
+    latency: float       # round trip, ms
+    jitter: float        # ms
+    distribution: str
+    bandwidth: float     # Mbit/s in each direction, 0 is unlimited
+
+
+def make_delay(config, rng):
+    """Return a function sampling the one-way delay (in seconds) of a
+    chunk of data.
+
+    Half of the round-trip latency is added in each direction.  The
+    jitter is the half-width of the range of a uniform distribution, the
+    standard deviation of a normal one, or the mean extra delay of a
+    (heavy-tailed) Pareto one.
+    """
+    base = config.latency / 2000
+    jitter = config.jitter / 1000
+
+    if not jitter or config.distribution == 'constant':
+        return lambda: base
+    elif config.distribution == 'uniform':
+        return lambda: max(base + rng.uniform(-jitter, jitter), 0)
+    elif config.distribution == 'normal':
+        return lambda: max(rng.gauss(base, jitter), 0)
+    elif config.distribution == 'pareto':
+        scale = jitter * (PARETO_SHAPE - 1)
+        return lambda: base + scale * (rng.paretovariate(PARETO_SHAPE) - 1)
+    else:
+        raise ValueError(
+            f'unknown delay distribution: {config.distribution!r}')
+
+
+async def sleep_until(deadline):
+    # Event loop timers only have millisecond resolution and round
+    # shorter delays down to nothing, so they only wait until shortly
+    # before the deadline, and a thread of the executor sleeps until
+    # the last SLEEP_SLACK without holding up the other connections.
+    # The kernel, and then the event loop, wake up a little late, so the
+    # end of the wait polls the clock instead.
+    delay = deadline - time.monotonic() - TIMER_RESOLUTION
+    if delay > 0:
+        await asyncio.sleep(delay)
+    delay = deadline - time.monotonic() - SLEEP_SLACK
+    if delay > 0:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, time.sleep, delay)
+    while time.monotonic() < deadline:
+        pass
+
+
+async def deliver(queue, writer):
+    try:
+        while True:
+            deadline, data = await queue.get()
+            if data is None:
+                break
+            await sleep_until(deadline)
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except ConnectionError:
+        pass
+
+
+async def forward(reader, writer, config, rng):
+    """Copy data from *reader* to *writer*, delaying every chunk."""
+    delay = make_delay(config, rng)
+    bytes_per_sec = config.bandwidth * 1e6 / 8
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    delivery = asyncio.ensure_future(deliver(queue, writer))
+
+    sent = 0.0
+    arrival = 0.0
+    try:
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            now = time.monotonic()
+            if bytes_per_sec:
+                # The link transmits one chunk after the other.
+                sent = max(sent, now) + len(data) / bytes_per_sec
+            else:
+                sent = now
+            # TCP delivers data in order, so a chunk is never received
+            # before the ones sent earlier.
+            arrival = max(sent + delay(), arrival)
+            await queue.put((arrival, data))
+    except ConnectionError:
+        pass
+    finally:
+        await queue.put((None, None))
+        await delivery
+
+
+async def handle(reader, writer, *, target, config):
+    try:
+        up_reader, up_writer = await asyncio.open_connection(*target)
+    except OSError:
+        writer.close()
+        return
+
+    rng = random.Random()
+    try:
+        await asyncio.gather(
+            forward(reader, up_writer, config, rng),
+            forward(up_reader, writer, config, rng),
+        )
+    finally:
+        writer.close()
+        up_writer.close()
+
+
+def serve(config, targets, pipe):
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(SLEEPERS))
+
+    ports = {}
+    for name, target in targets.items():
+        server = loop.run_until_complete(asyncio.start_server(
+            functools.partial(handle, target=target, config=config),
+            '127.0.0.1', 0))
+        ports[name] = server.sockets[0].getsockname()[1]
+    pipe.send(ports)
+    pipe.close()
+
+    loop.run_forever()
+
+
+class NetProxy:
+    """A TCP proxy simulating the network between clients and databases.
+
+    The proxy runs in a separate process, so that it does not compete
+    with the clients for their event loops, and listens on a local port
+    for each of the *targets*, a dict of ``(host, port)`` addresses.
+    """
+
+    def __init__(self, config: NetConfig, targets):
+        self.config = config
+        self.targets = targets
+        self.ports = None
+        self._process = None
+
+    def start(self):
+        parent_pipe, child_pipe = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(
+            target=serve, args=(self.config, self.targets, child_pipe),
+            daemon=True)
+        self._process.start()
+        child_pipe.close()
+        try:
+            self.ports = parent_pipe.recv()
+        except EOFError:
+            self._process.join()
+            raise RuntimeError('could not start the network proxy')
+        finally:
+            parent_pipe.close()
+        return self.ports
+
+    def close(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
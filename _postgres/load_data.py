@@ -1,98 +1,253 @@
 import argparse
-import psycopg2
-import json
+import asyncio
+import concurrent.futures
+import os
+import time
+
+import asyncpg
 import tqdm
 
+import _dataset
+
+
+# Tables with their columns and how to get them from the objects of the
+# dataset.
+TABLES = [
+    (
+        "User",
+        "users",
+        {
+            "id": "id",
+            "email": "email",
+            "hashed_password": "hashed_password",
+            "is_active": "is_active",
+            "is_superuser": "is_superuser",
+            "is_verified": "is_verified",
+            "first_name": "first_name",
+            "last_name": "last_name",
+            "username": "username",
+            "age": "age",
+        },
+    ),
+    (
+        "Question",
+        "questions",
+        {
+            "id": "id",
+            "content": "content",
+            "title": "title",
+            "upvote": "upvote",
+            "downvote": "downvote",
+            "author_id": "author",
+            "tags": "tags",
+        },
+    ),
+    (
+        "Answer",
+        "answers",
+        {
+            "id": "id",
+            "content": "content",
+            "upvote": "upvote",
+            "downvote": "downvote",
+            "author_id": "author",
+            "question_id": "question",
+            "is_accepted": "is_accepted",
+        },
+    ),
+    (
+        "Comment",
+        "comments",
+        {
+            "id": "id",
+            "content": "content",
+            "upvote": "upvote",
+            "downvote": "downvote",
+            "author_id": "author",
+            "question_id": "question",
+            "answer_id": "answer",
+        },
+    ),
+]
+
+
+# The references between the tables: (table, column, referenced table).
+# Each gets a foreign key and an index, added after loading.
+REFERENCES = [
+    ("Question", "author_id", "User"),
+    ("Answer", "author_id", "User"),
+    ("Answer", "question_id", "Question"),
+    ("Comment", "author_id", "User"),
+    ("Comment", "question_id", "Question"),
+    ("Comment", "answer_id", "Answer"),
+]
+
+# Rows per COPY (a multiple of _dataset.INDEX_STEP, where reading can
+# start); the partitions are loaded by several processes at once.
+PARTITION_SIZE = 10000
+
+CONNECT_ARGS = dict(
+    host="localhost",
+    port=3500,
+    database="postgres_bench",
+    user="postgres_bench",
+    password="edgedbbenchmark",
+)
+
+# The dataset, in the worker processes.
+worker_dataset = None
+
+
+def report(label, rows, duration):
+    print(f"{label}: {rows} rows in {duration:.1f}s ({rows / duration:.0f} rows/s)")
+
+
+def report_phase(label, duration):
+    print(f"{label}: {duration:.1f}s")
+
+
+def records(objects, fields):
+    for obj in objects:
+        yield tuple(obj[field] for field in fields)
+
+
+def init_worker(dataset):
+    global worker_dataset
+    worker_dataset = dataset
+
+
+async def _copy_partition(table, key, columns, start, stop):
+    conn = await asyncpg.connect(**CONNECT_ARGS)
+    try:
+        objects = (
+            obj
+            for batch in worker_dataset.batches(key, PARTITION_SIZE, start, stop)
+            for obj in batch
+        )
+        # The binary COPY protocol, no quoting or escaping of values.
+        await conn.copy_records_to_table(
+            table, records=records(objects, columns.values()), columns=list(columns)
+        )
+    finally:
+        await conn.close()
+
+
+def copy_partition(table, key, columns, start, stop):
+    """Copy the records *start* to *stop* of *key* into *table*, in a
+    worker process, which decodes them as they are sent."""
+    asyncio.run(_copy_partition(table, key, columns, start, stop))
+    return table, min(stop, worker_dataset.counts[key]) - start
 
-def import_data(data):
-    # Establish a connection to the PostgreSQL database
-    users = data["users"]
-    questions = data["questions"]
-    answers = data["answers"]
-    comments = data["comments"]
 
-    conn = psycopg2.connect(
-        host="localhost",
-        port="3500",
-        database="postgres_bench",
-        user="postgres_bench",
-        password="edgedbbenchmark",
+async def load_tables(pool, dataset, jobs):
+    # With no indexes and foreign keys yet, the tables do not depend on
+    # each other and all the partitions can go in at the same time.
+    # Decoding the dataset takes a core of its own, so every partition
+    # is decoded by the process copying it rather than here.
+    loop = asyncio.get_running_loop()
+    bars = {
+        table: tqdm.tqdm(desc=f"{table}: ", total=dataset.counts[key], position=i)
+        for i, (table, key, _) in enumerate(TABLES)
+    }
+
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=init_worker, initargs=(dataset,)
+    ) as executor:
+        partitions = [
+            loop.run_in_executor(
+                executor,
+                copy_partition,
+                table,
+                key,
+                columns,
+                start,
+                start + PARTITION_SIZE,
+            )
+            for table, key, columns in TABLES
+            for start in range(0, dataset.counts[key], PARTITION_SIZE)
+        ]
+        for partition in asyncio.as_completed(partitions):
+            table, rows = await partition
+            bars[table].update(rows)
+    for bar in bars.values():
+        bar.close()
+
+    # The IDs come from the dataset, new rows get the next ones.
+    await run_all(
+        pool,
+        (
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), max(id)) "
+            f'FROM "{table}"'
+            for table, _, _ in TABLES
+        ),
+    )
+    return sum(dataset.counts[key] for _, key, _ in TABLES)
+
+
+async def run_all(pool, statements):
+    # One connection of the pool per statement at a time.
+    await asyncio.gather(*(pool.execute(statement) for statement in statements))
+
+
+async def create_indexes(pool):
+    await run_all(
+        pool,
+        (
+            f'CREATE INDEX "idx_{table.lower()}_{column}" ON "{table}" ({column})'
+            for table, column, _ in REFERENCES
+        ),
     )
 
-    cursor = conn.cursor()
-
-    for user in tqdm.tqdm(users, desc="Users: ", total=len(users)):
-        id = user["id"]
-        email = user["email"].replace("'", "''")
-        hashed_password = user["hashed_password"].replace("'", "''")
-        is_active = user["is_active"]
-        is_superuser = user["is_superuser"]
-        is_verified = user["is_verified"]
-        first_name = user["first_name"].replace("'", "''")
-        last_name = user["last_name"].replace("'", "''")
-        username = user["username"].replace("'", "''")
-        age = user["age"]
-
-        insert_query = f"""
-            INSERT INTO "User" (email, hashed_password, is_active, is_superuser, is_verified, first_name, last_name, username, age)
-            VALUES ('{email}', '{hashed_password}', {is_active}, {is_superuser}, {is_verified}, '{first_name}', '{last_name}', '{username}', {age});
-            """
-
-        cursor.execute(insert_query)
-
-    for question in tqdm.tqdm(questions, desc="Questions: ", total=len(questions)):
-        id = question["id"]
-        content = question["content"].replace("'", "''")
-        title = question["title"].replace("'", "''")
-        upvote = question["upvote"]
-        downvote = question["downvote"]
-        author_id = question["author"]
-        tags = "'{" + ",".join(question["tags"]) + "}'"
-
-        insert_query = f"""
-            INSERT INTO "Question" (content, title, upvote, downvote, author_id, tags)
-            VALUES ('{content}', '{title}', {upvote}, {downvote}, {author_id}, {tags});
-            """
-
-        cursor.execute(insert_query)
-
-    for answer in tqdm.tqdm(answers, desc="Answers: ", total=len(answers)):
-        id = answer["id"]
-        content = answer["content"].replace("'", "''")
-        upvote = answer["upvote"]
-        downvote = answer["downvote"]
-        author_id = answer["author"]
-        question_id = answer["question"]
-        is_accepted = answer["is_accepted"]
-
-        insert_query = f"""
-            INSERT INTO "Answer" (content, upvote, downvote, author_id, question_id, is_accepted)
-            VALUES ('{content}', {upvote}, {downvote}, {author_id}, {question_id}, {is_accepted});
-            """
-
-        cursor.execute(insert_query)
-
-    for comment in tqdm.tqdm(comments, desc="Comments: ", total=len(comments)):
-        id = comment["id"]
-        content = comment["content"].replace("'", "''")
-        upvote = comment["upvote"]
-        downvote = comment["downvote"]
-        author_id = comment["author"]
-        question_id = comment["question"]
-        answer_id = comment["answer"]
-
-        insert_query = f"""
-            INSERT INTO "Comment" (content, upvote, downvote, author_id, question_id, answer_id)
-            VALUES ('{content}', {upvote}, {downvote}, {author_id}, {question_id}, {answer_id});
-            """
-
-        cursor.execute(insert_query)
-
-    # Commit the changes to the database
-    conn.commit()
-    # Close the cursor and the database connection
-    cursor.close()
-    conn.close()
+
+async def add_foreign_keys(pool):
+    # Adding a valid foreign key locks both tables against other foreign
+    # keys while checking every row.  Added as NOT VALID it only takes a
+    # moment; validating it then only locks its own table against other
+    # validations, so the tables are checked at the same time, and the
+    # foreign keys of a table one after the other.
+    async with pool.acquire() as conn:
+        for table, column, referenced in REFERENCES:
+            await conn.execute(
+                f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_{column}_fkey" '
+                f'FOREIGN KEY ({column}) REFERENCES "{referenced}" (id) NOT VALID'
+            )
+
+    async def validate(table):
+        async with pool.acquire() as conn:
+            for referencing, column, _ in REFERENCES:
+                if referencing == table:
+                    await conn.execute(
+                        f'ALTER TABLE "{table}" '
+                        f'VALIDATE CONSTRAINT "{table}_{column}_fkey"'
+                    )
+
+    await asyncio.gather(*(validate(table) for table, _, _ in TABLES))
+
+
+async def analyze(pool):
+    await run_all(pool, (f'ANALYZE "{table}"' for table, _, _ in TABLES))
+
+
+async def import_data(dataset, jobs):
+    pool = await asyncpg.create_pool(**CONNECT_ARGS, min_size=1, max_size=jobs)
+
+    try:
+        start = time.monotonic()
+        rows = await load_tables(pool, dataset, jobs)
+        report("Load", rows, time.monotonic() - start)
+
+        for label, phase in [
+            ("Indexes", create_indexes),
+            ("Foreign keys", add_foreign_keys),
+            ("Analyze", analyze),
+        ]:
+            phase_start = time.monotonic()
+            await phase(pool)
+            report_phase(label, time.monotonic() - phase_start)
+
+        report("Total", rows, time.monotonic() - start)
+    finally:
+        await pool.close()
 
 
 if __name__ == "__main__":
@@ -100,10 +255,13 @@ if __name__ == "__main__":
         description="Load a specific fixture, old data will be purged."
     )
     parser.add_argument("filename", type=str, help="The JSON dataset file")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes (and connections) to load the tables with",
+    )
 
     args = parser.parse_args()
 
-    with open(args.filename, "rt") as f:
-        data = json.load(f)
-
-    import_data(data)
+    asyncio.run(import_data(_dataset.Dataset(args.filename), args.jobs))
@@ -1,10 +1,28 @@
 import asyncpg
+import collections
 import json
 import random
 
+import _idcache
+import _instrument
+
+from . import sampling
+from . import snapshot
+from . import stats
+
 
 ASYNC = True
 INSERT_PREFIX = "insert_test__"
+INSERT_TABLES = {"insert_user": "User", "update_comments_on_answer": "Comment"}
+
+write_isolation = "none"
+# IDs of the rows inserted by each query, with bulk-delete isolation.
+inserted = collections.defaultdict(list)
+
+
+def init(ctx):
+    global write_isolation
+    write_isolation = ctx.write_isolation
 
 
 async def connect(ctx):
@@ -21,34 +39,63 @@ async def close(ctx, conn):
     await conn.close()
 
 
-async def load_ids(ctx, conn):
-    users = await conn.fetch(
-        f'SELECT id FROM "User" ORDER BY random() LIMIT {ctx.number_of_ids}'
-    )
+async def server_stats(ctx, conn):
+    return await stats.snapshot(conn.fetch)
 
-    questions = await conn.fetch(
-        f'SELECT id FROM "Question" ORDER BY random() LIMIT {ctx.number_of_ids}'
-    )
 
-    answers = await conn.fetch(
-        f'SELECT id FROM "Answer" ORDER BY random() LIMIT {ctx.number_of_ids}'
-    )
+server_stats_delta = stats.delta
+
+
+async def save_snapshot(ctx):
+    await snapshot.save(ctx, "postgres_bench", owner="postgres_bench")
 
-    comments = await conn.fetch(
-        f'SELECT id FROM "Comment" ORDER BY random() LIMIT {ctx.number_of_ids}'
+
+async def restore_snapshot(ctx):
+    await snapshot.restore(ctx, "postgres_bench", owner="postgres_bench")
+
+
+async def write(conn, queryname, query):
+    if write_isolation == "rollback":
+        with _instrument.phase(_instrument.ISOLATION):
+            tx = conn.transaction()
+            await tx.start()
+        try:
+            with _instrument.phase(_instrument.WAIT):
+                return await conn.fetch(query)
+        finally:
+            with _instrument.phase(_instrument.ISOLATION):
+                await tx.rollback()
+
+    with _instrument.phase(_instrument.WAIT):
+        rows = await conn.fetch(query)
+    if write_isolation == "bulk-delete":
+        with _instrument.phase(_instrument.ISOLATION):
+            inserted[queryname].append(rows[0]["id"])
+    return rows
+
+
+async def load_ids(ctx, conn):
+    pools = await _idcache.load_pools(
+        ctx,
+        "postgres",
+        await sampling.fingerprint(conn.fetch),
+        lambda rng: sampling.sample(conn.fetch, ctx.number_of_ids, rng),
     )
+    users = pools["User"]
+    answers = pools["Answer"]
+    questions = pools["Question"]
 
     return dict(
-        get_answer=[a[0] for a in answers],
-        get_comments_on_question=[q[0] for q in questions],
+        get_answer=answers,
+        get_comments_on_question=questions,
         # generate as many insert stubs as "concurrency" to
         # accommodate concurrent inserts
         insert_user=[INSERT_PREFIX] * ctx.concurrency,
         update_comments_on_answer=[
             {
                 "prefix": INSERT_PREFIX,
-                "answer_id": [a[0] for a in answers],
-                "author_id": [u[0] for u in users],
+                "answer_id": answers,
+                "author_id": users,
             }
         ]
         * ctx.concurrency,
@@ -56,8 +103,8 @@ async def load_ids(ctx, conn):
 
 
 async def get_answer(conn, id):
-    rows = await conn.fetch(
-        f"""
+    with _instrument.phase(_instrument.ENCODE):
+        query = f"""
         SELECT
             a.content,
             a.upvote,
@@ -76,27 +123,28 @@ async def get_answer(conn, id):
         WHERE
             a.id = {id}
     """
-    )
-
-    return json.dumps(
-        {
-            "content": rows[0]["content"],
-            "upvote": rows[0]["upvote"],
-            "downvote": rows[0]["downvote"],
-            "is_accepted": rows[0]["is_accepted"],
-            "author_email": rows[0]["author_email"],
-            "author_username": rows[0]["author_username"],
-            "comments": [row["comment_content"] for row in rows],
-            "comments_upvotes": [row["comment_upvote"] for row in rows],
-            "comments_downvotes": [row["comment_downvote"] for row in rows],
-            "comment_author_id": [row["comment_author_id"] for row in rows],
-        }
-    )
+    with _instrument.phase(_instrument.WAIT):
+        rows = await conn.fetch(query)
+    with _instrument.phase(_instrument.POSTPROCESS):
+        return json.dumps(
+            {
+                "content": rows[0]["content"],
+                "upvote": rows[0]["upvote"],
+                "downvote": rows[0]["downvote"],
+                "is_accepted": rows[0]["is_accepted"],
+                "author_email": rows[0]["author_email"],
+                "author_username": rows[0]["author_username"],
+                "comments": [row["comment_content"] for row in rows],
+                "comments_upvotes": [row["comment_upvote"] for row in rows],
+                "comments_downvotes": [row["comment_downvote"] for row in rows],
+                "comment_author_id": [row["comment_author_id"] for row in rows],
+            }
+        )
 
 
 async def get_comments_on_question(conn, id):
-    rows = await conn.fetch(
-        f"""
+    with _instrument.phase(_instrument.ENCODE):
+        query = f"""
             WITH comments_ids AS (
                 SELECT c.id
                 FROM "Comment" AS c
@@ -116,65 +164,76 @@ async def get_comments_on_question(conn, id):
             WHERE
                 c.id IN (SELECT id FROM comments_ids)
         """
-    )
-
-    return json.dumps(
-        {
-            "comments": [row["content"] for row in rows],
-            "upvotes": [row["upvote"] for row in rows],
-            "downvotes": [row["downvote"] for row in rows],
-            "author_ids": [row["author_id"] for row in rows],
-            "author_emails": [row["author_email"] for row in rows],
-            "author_usernames": [row["author_username"] for row in rows],
-        }
-    )
+    with _instrument.phase(_instrument.WAIT):
+        rows = await conn.fetch(query)
+    with _instrument.phase(_instrument.POSTPROCESS):
+        return json.dumps(
+            {
+                "comments": [row["content"] for row in rows],
+                "upvotes": [row["upvote"] for row in rows],
+                "downvotes": [row["downvote"] for row in rows],
+                "author_ids": [row["author_id"] for row in rows],
+                "author_emails": [row["author_email"] for row in rows],
+                "author_usernames": [row["author_username"] for row in rows],
+            }
+        )
 
 
 async def insert_user(conn, val):
-    num = random.randrange(10, 100)
-    rows = await conn.fetch(
-        f"""
+    with _instrument.phase(_instrument.ENCODE):
+        num = random.randrange(10, 100)
+        query = f"""
             INSERT INTO "User" (age, email, first_name, last_name, username, hashed_password)
             VALUES ({num}, '{val}{num}@test.com', '{val}{num+1}', '{val}{num+2}', '{val}{num+3}', '{val}{num+4}')
             RETURNING id, username, email, age, first_name, last_name
         """
-    )
-
-    return json.dumps(
-        {
-            "id": rows[0]["id"],
-            "username": rows[0]["username"],
-            "email": rows[0]["email"],
-            "first_name": rows[0]["first_name"],
-            "last_name": rows[0]["last_name"],
-        }
-    )
+    rows = await write(conn, "insert_user", query)
+    with _instrument.phase(_instrument.POSTPROCESS):
+        return json.dumps(
+            {
+                "id": rows[0]["id"],
+                "username": rows[0]["username"],
+                "email": rows[0]["email"],
+                "first_name": rows[0]["first_name"],
+                "last_name": rows[0]["last_name"],
+            }
+        )
 
 
 async def update_comments_on_answer(conn, val):
-    num = random.randrange(10_000)
-    rows = await conn.fetch(
-        f"""
+    with _instrument.phase(_instrument.ENCODE):
+        num = random.randrange(10_000)
+        query = f"""
             INSERT INTO "Comment" (upvote, downvote, content, author_id, answer_id)
             VALUES ({num}, {num // 10}, '{val['prefix']}{num}', {random.choice(val["author_id"])}, {random.choice(val["answer_id"])})
             RETURNING id, upvote, downvote, content, author_id, answer_id
         """
-    )
-
-    return json.dumps(
-        {
-            "id": rows[0]["id"],
-            "upvote": rows[0]["upvote"],
-            "downvote": rows[0]["downvote"],
-            "content": rows[0]["content"],
-            "author_id": rows[0]["author_id"],
-            "answer_id": rows[0]["answer_id"],
-        }
-    )
+    rows = await write(conn, "update_comments_on_answer", query)
+    with _instrument.phase(_instrument.POSTPROCESS):
+        return json.dumps(
+            {
+                "id": rows[0]["id"],
+                "upvote": rows[0]["upvote"],
+                "downvote": rows[0]["downvote"],
+                "content": rows[0]["content"],
+                "author_id": rows[0]["author_id"],
+                "answer_id": rows[0]["answer_id"],
+            }
+        )
 
 
 async def cleanup(ctx, conn, queryname):
-    if queryname == "insert_user":
+    if write_isolation == "rollback":
+        # Nothing was left behind.
+        return
+    elif write_isolation == "bulk-delete":
+        ids = inserted.pop(queryname, None)
+        if ids:
+            await conn.execute(
+                f'DELETE FROM "{INSERT_TABLES[queryname]}" WHERE id = ANY($1)',
+                ids,
+            )
+    elif queryname == "insert_user":
         await conn.fetch(
             f"""
             DELETE FROM "User"
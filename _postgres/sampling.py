@@ -0,0 +1,73 @@
+"""Random samples of the primary keys of the benchmark tables.
+
+``ORDER BY random()`` scans and sorts whole tables.  Instead, random
+keys are drawn between the lowest and the highest ID of a table (found
+with its primary key index) and looked up, until enough of them exist,
+so sampling costs the same on any size of dataset.  Queries go through
+a *fetch* coroutine function like in the stats module.
+"""
+
+import typing
+
+
+TABLES = ("User", "Question", "Answer", "Comment")
+
+# Extra candidates drawn for the IDs that may be missing (deleted rows,
+# sequence gaps).
+OVERSAMPLING = 1.25
+
+
+async def _bounds(fetch, table):
+    rows = await fetch(f'SELECT min(id) AS lo, max(id) AS hi FROM "{table}"')
+    return rows[0]["lo"], rows[0]["hi"]
+
+
+async def fingerprint(fetch) -> typing.List[typing.Tuple[str, int, int]]:
+    """Identify the dataset by the ID range of every table."""
+    return [(table, *await _bounds(fetch, table)) for table in TABLES]
+
+
+async def sample_table(fetch, table, n, rng) -> typing.List[int]:
+    lo, hi = await _bounds(fetch, table)
+    if lo is None:
+        return []
+
+    ids = []
+    tried = set()
+    density = 1.0
+    while len(ids) < n and len(tried) < hi - lo + 1:
+        want = min(
+            round((n - len(ids)) / density * OVERSAMPLING) + 1,
+            hi - lo + 1 - len(tried),
+        )
+        if want * 2 >= hi - lo + 1 - len(tried):
+            # Little of the range is left untried, take all of it
+            # rather than drawing tried keys over and over.
+            candidates = [i for i in range(lo, hi + 1) if i not in tried]
+            rng.shuffle(candidates)
+            candidates = candidates[:want]
+            tried.update(candidates)
+        else:
+            candidates = []
+            while len(candidates) < want:
+                candidate = rng.randint(lo, hi)
+                if candidate not in tried:
+                    candidates.append(candidate)
+                    tried.add(candidate)
+
+        rows = await fetch(
+            f'SELECT id FROM "{table}" '
+            f'WHERE id IN ({", ".join(map(str, candidates))})'
+        )
+        found = {row["id"] for row in rows}
+        # Keep the (random) order of the candidates, the order of the
+        # rows is up to the server.
+        ids.extend(c for c in candidates if c in found)
+        density = max(len(ids) / len(tried), 1 / (hi - lo + 1))
+
+    return ids[:n]
+
+
+async def sample(fetch, n, rng) -> typing.Dict[str, typing.List[int]]:
+    """Sample *n* IDs of every table, using the random.Random *rng*."""
+    return {table: await sample_table(fetch, table, n, rng) for table in TABLES}
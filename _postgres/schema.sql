@@ -1,3 +1,7 @@
+-- The bare tables: the foreign keys and the indexes on them are added by
+-- load_data.py once the dataset is loaded, which is much faster than
+-- checking and indexing every row as it is copied in.
+
 CREATE TABLE "User"
 (
     id              SERIAL PRIMARY KEY,
@@ -19,12 +23,11 @@ CREATE TABLE "Question"
     content     TEXT                   NOT NULL,
     upvote      SMALLINT DEFAULT 0     NOT NULL,
     downvote    SMALLINT DEFAULT 0     NOT NULL,
-    author_id   INTEGER                NOT NULL REFERENCES "User" (id),
+    author_id   INTEGER                NOT NULL,
     title       VARCHAR(255)           NOT NULL,
     tags        VARCHAR(255)[],
     is_accepted BOOLEAN  DEFAULT false NOT NULL
 );
-CREATE INDEX idx_question_author_id ON "Question" (author_id);
 
 
 CREATE TABLE "Answer"
@@ -33,12 +36,10 @@ CREATE TABLE "Answer"
     content     TEXT                   NOT NULL,
     upvote      SMALLINT DEFAULT 0     NOT NULL,
     downvote    SMALLINT DEFAULT 0     NOT NULL,
-    author_id   INTEGER                NOT NULL REFERENCES "User" (id),
-    question_id INTEGER                NOT NULL REFERENCES "Question" (id),
+    author_id   INTEGER                NOT NULL,
+    question_id INTEGER                NOT NULL,
     is_accepted BOOLEAN  DEFAULT false NOT NULL
 );
-CREATE INDEX idx_answer_author_id ON "Answer" (author_id);
-CREATE INDEX idx_answer_question_id ON "Answer" (question_id);
 
 CREATE TABLE "Comment"
 (
@@ -46,10 +47,7 @@ CREATE TABLE "Comment"
     content     TEXT               NOT NULL,
     upvote      SMALLINT DEFAULT 0 NOT NULL,
     downvote    SMALLINT DEFAULT 0 NOT NULL,
-    author_id   INTEGER            NOT NULL REFERENCES "User" (id),
-    question_id INTEGER REFERENCES "Question" (id),
-    answer_id   INTEGER REFERENCES "Answer" (id)
+    author_id   INTEGER            NOT NULL,
+    question_id INTEGER,
+    answer_id   INTEGER
 );
-CREATE INDEX idx_comment_author_id ON "Comment" (author_id);
-CREATE INDEX idx_comment_question_id ON "Comment" (question_id);
-CREATE INDEX idx_comment_answer_id ON "Comment" (answer_id);
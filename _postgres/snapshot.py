@@ -0,0 +1,72 @@
+"""Snapshots of the benchmark databases as template databases.
+
+Copying a template database copies its files, which takes seconds
+where loading the dataset takes minutes.  The snapshot of a database
+is kept as "<database>_snapshot", which nobody can connect to.
+"""
+
+import asyncpg
+
+
+async def _connect(ctx):
+    # Creating and dropping databases of other owners takes a superuser.
+    return await asyncpg.connect(
+        user="postgres",
+        database="postgres",
+        host=ctx.db_host,
+        port=ctx.pg_port,
+    )
+
+
+def snapshot_name(database):
+    return f"{database}_snapshot"
+
+
+async def _exists(conn, database):
+    return await conn.fetchval(
+        "SELECT 1 FROM pg_database WHERE datname = $1", database
+    )
+
+
+async def _copy(conn, source, target, owner):
+    # Copying needs the source to be free of connections.
+    await conn.execute(
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+        "WHERE datname = $1 AND pid <> pg_backend_pid()",
+        source,
+    )
+    await conn.execute(
+        f'CREATE DATABASE "{target}" TEMPLATE "{source}" OWNER "{owner}"'
+    )
+
+
+async def save(ctx, database, owner):
+    snapshot = snapshot_name(database)
+    conn = await _connect(ctx)
+    try:
+        if await _exists(conn, snapshot):
+            # A template cannot be dropped.
+            await conn.execute(f'ALTER DATABASE "{snapshot}" IS_TEMPLATE false')
+            await conn.execute(f'DROP DATABASE "{snapshot}"')
+        await _copy(conn, database, snapshot, owner)
+        await conn.execute(
+            f'ALTER DATABASE "{snapshot}" '
+            "WITH IS_TEMPLATE true ALLOW_CONNECTIONS false"
+        )
+    finally:
+        await conn.close()
+
+
+async def restore(ctx, database, owner):
+    snapshot = snapshot_name(database)
+    conn = await _connect(ctx)
+    try:
+        if not await _exists(conn, snapshot):
+            raise RuntimeError(
+                f"there is no snapshot of {database}, "
+                f"run `python snapshot.py save` after loading the dataset"
+            )
+        await conn.execute(f'DROP DATABASE IF EXISTS "{database}" WITH (FORCE)')
+        await _copy(conn, snapshot, database, owner)
+    finally:
+        await conn.close()
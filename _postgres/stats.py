@@ -0,0 +1,194 @@
+"""Server-side statistics of PostgreSQL, for the implementations that
+benchmark it.
+
+snapshot() reads the cumulative statistics views through a *fetch*
+coroutine function (e.g. ``asyncpg.Connection.fetch``) returning rows
+with mapping access, and delta() turns two snapshots into the activity
+of the server in between.  Sections that cannot be read (e.g. without
+the pg_stat_statements extension, or privileges) are None.
+"""
+
+import typing
+
+
+STATEMENTS_COUNTERS = [
+    "calls",
+    "rows",
+    "shared_blks_hit",
+    "shared_blks_read",
+    "shared_blks_dirtied",
+    "shared_blks_written",
+    "temp_blks_read",
+    "temp_blks_written",
+    "wal_bytes",
+]
+
+DATABASE_COUNTERS = [
+    "xact_commit",
+    "xact_rollback",
+    "blks_read",
+    "blks_hit",
+    "tup_returned",
+    "tup_fetched",
+    "tup_inserted",
+    "tup_updated",
+    "tup_deleted",
+    "temp_files",
+    "temp_bytes",
+    "deadlocks",
+]
+
+TABLES_COUNTERS = [
+    "seq_scan",
+    "seq_tup_read",
+    "idx_scan",
+    "idx_tup_fetch",
+    "n_tup_ins",
+    "n_tup_upd",
+    "n_tup_del",
+    "n_tup_hot_upd",
+]
+
+STATIO_COUNTERS = [
+    "heap_blks_read",
+    "heap_blks_hit",
+    "idx_blks_read",
+    "idx_blks_hit",
+    "toast_blks_read",
+    "toast_blks_hit",
+]
+
+# Statements of the snapshots themselves, which are not part of a
+# benchmark.
+OWN_STATEMENTS = ("pg_stat", "pg_extension", "pg_current_wal_lsn")
+
+TOP_STATEMENTS = 5
+
+
+async def _statements(fetch):
+    installed = await fetch(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'"
+    )
+    if not installed:
+        return None
+
+    rows = await fetch(
+        """
+        SELECT s.*
+        FROM pg_stat_statements AS s
+        INNER JOIN pg_database AS d ON d.oid = s.dbid
+        WHERE d.datname = current_database()
+        """
+    )
+    statements = {}
+    for row in rows:
+        row = dict(row)
+        if any(name in (row["query"] or "") for name in OWN_STATEMENTS):
+            continue
+        # The execution time column was renamed in PostgreSQL 13.
+        exec_time = row.get("total_exec_time", row.get("total_time")) or 0
+        statements[str(row["queryid"])] = dict(
+            query=row["query"],
+            exec_time=exec_time,
+            **{key: row.get(key) or 0 for key in STATEMENTS_COUNTERS},
+        )
+    return statements
+
+
+async def _database(fetch):
+    rows = await fetch(
+        "SELECT * FROM pg_stat_database WHERE datname = current_database()"
+    )
+    return {key: rows[0][key] or 0 for key in DATABASE_COUNTERS}
+
+
+async def _tables(fetch, view, counters):
+    rows = await fetch(f"SELECT * FROM {view}")
+    return {
+        row["relname"]: {key: row[key] or 0 for key in counters}
+        for row in rows
+    }
+
+
+async def _wal_lsn(fetch):
+    rows = await fetch("SELECT pg_current_wal_lsn()::text AS lsn")
+    high, low = rows[0]["lsn"].split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+async def snapshot(fetch) -> typing.Dict[str, typing.Any]:
+    sections = dict(
+        statements=lambda: _statements(fetch),
+        database=lambda: _database(fetch),
+        tables=lambda: _tables(fetch, "pg_stat_user_tables", TABLES_COUNTERS),
+        io=lambda: _tables(fetch, "pg_statio_user_tables", STATIO_COUNTERS),
+        wal_lsn=lambda: _wal_lsn(fetch),
+    )
+    data = {}
+    for name, read in sections.items():
+        try:
+            data[name] = await read()
+        except Exception:
+            data[name] = None
+    return data
+
+
+def _sub(before, after, keys):
+    return {key: after[key] - before.get(key, 0) for key in keys}
+
+
+def _sum(rows, keys):
+    return {key: sum(row[key] for row in rows) for key in keys}
+
+
+def delta(before, after) -> typing.Dict[str, typing.Any]:
+    """Return the server activity between two snapshots.
+
+    Execution times are in milliseconds, WAL in bytes.
+    """
+    result = dict.fromkeys(["statements", "database", "tables", "io"])
+
+    if before["statements"] is not None and after["statements"] is not None:
+        changed = []
+        for queryid, stmt in after["statements"].items():
+            prev = before["statements"].get(queryid, {})
+            diff = _sub(prev, stmt, ["exec_time"] + STATEMENTS_COUNTERS)
+            if diff["calls"] > 0:
+                changed.append(dict(query=stmt["query"], **diff))
+        changed.sort(key=lambda s: s["exec_time"], reverse=True)
+        result["statements"] = dict(
+            _sum(changed, ["exec_time"] + STATEMENTS_COUNTERS),
+            top=[
+                dict(
+                    query=" ".join(s["query"].split())[:200],
+                    calls=s["calls"],
+                    mean_exec_time=s["exec_time"] / s["calls"],
+                )
+                for s in changed[:TOP_STATEMENTS]
+            ],
+        )
+
+    if before["database"] is not None and after["database"] is not None:
+        result["database"] = _sub(
+            before["database"], after["database"], DATABASE_COUNTERS
+        )
+
+    for section, counters in (
+        ("tables", TABLES_COUNTERS),
+        ("io", STATIO_COUNTERS),
+    ):
+        if before[section] is not None and after[section] is not None:
+            result[section] = _sum(
+                [
+                    _sub(before[section].get(table, {}), stats, counters)
+                    for table, stats in after[section].items()
+                ],
+                counters,
+            )
+
+    if before["wal_lsn"] is not None and after["wal_lsn"] is not None:
+        result["wal_bytes"] = after["wal_lsn"] - before["wal_lsn"]
+    else:
+        result["wal_bytes"] = None
+
+    return result
@@ -0,0 +1,85 @@
+import collections
+import os.path
+import signal
+import time
+
+
+class Sampler:
+    """A statistical profiler of the main thread.
+
+    The process gets a SIGPROF signal every *interval* seconds of CPU
+    time, and the handler counts the collapsed stack of the interrupted
+    frame, the input format of flame graph tools (flamegraph.pl,
+    speedscope, ...).  Time spent waiting (for the database) is not
+    sampled, so the profile shows where the client burns CPU.  The time
+    spent in the handler is kept as the overhead of profiling.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.cpu_time = 0.0
+        self.process_cpu_time = 0.0
+        self._labels = {}
+        self._started_at = None
+
+    def start(self):
+        self._started_at = time.process_time()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        # A signal may still be pending.
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.process_cpu_time += time.process_time() - self._started_at
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '{} ({}:{})'.format(
+                code.co_name,
+                os.path.basename(code.co_filename),
+                code.co_firstlineno,
+            )
+        return label
+
+    def _collapse(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+    def _sample(self, signum, frame):
+        started_at = time.perf_counter()
+        self.stacks[self._collapse(frame)] += 1
+        self.cpu_time += time.perf_counter() - started_at
+
+
+def write_collapsed(stacks, filename):
+    with open(filename, 'wt') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+
+
+def read_collapsed(filename):
+    stacks = collections.Counter()
+    with open(filename, 'rt') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            stacks[stack] += int(count)
+    return stacks
+
+
+def top_frames(stacks, limit=10):
+    """Return the frames with the most samples at the top of the stack,
+    as ``(frame, share of samples)`` pairs."""
+    total = sum(stacks.values())
+    self_counts = collections.Counter()
+    for stack, count in stacks.items():
+        self_counts[stack.rpartition(';')[2]] += count
+    return [
+        (frame, count / total)
+        for frame, count in self_counts.most_common(limit)
+    ]
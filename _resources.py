@@ -0,0 +1,91 @@
+import resource
+import typing
+
+
+class ResourceUsage(typing.NamedTuple):
+    """Resources used by client processes."""
+
+    user_time: float            # seconds
+    system_time: float          # seconds
+    voluntary_switches: int
+    involuntary_switches: int
+    peak_rss: int               # bytes
+
+    @property
+    def cpu_time(self):
+        return self.user_time + self.system_time
+
+
+def _peak_rss(ru):
+    try:
+        with open('/proc/self/status', 'rt') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Kilobytes on Linux, and the peak since the start of the process.
+    return ru.ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """Make the peak RSS start from the current RSS, where supported
+    (Linux 4.0+)."""
+    try:
+        with open('/proc/self/clear_refs', 'wt') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def snapshot():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ResourceUsage(
+        user_time=ru.ru_utime,
+        system_time=ru.ru_stime,
+        voluntary_switches=ru.ru_nvcsw,
+        involuntary_switches=ru.ru_nivcsw,
+        peak_rss=_peak_rss(ru),
+    )
+
+
+def since(before):
+    """Return the resources used since the *before* snapshot."""
+    after = snapshot()
+    return ResourceUsage(
+        user_time=after.user_time - before.user_time,
+        system_time=after.system_time - before.system_time,
+        voluntary_switches=(
+            after.voluntary_switches - before.voluntary_switches),
+        involuntary_switches=(
+            after.involuntary_switches - before.involuntary_switches),
+        peak_rss=after.peak_rss,
+    )
+
+
+def total(usages, *, concurrent):
+    """Add up resource usages.
+
+    The peak RSS of *concurrent* processes adds up, while for
+    consecutive measurements of the same processes it is the highest.
+    """
+    usages = list(usages)
+    peak_rss = (sum if concurrent else max)(u.peak_rss for u in usages)
+    return ResourceUsage(
+        user_time=sum(u.user_time for u in usages),
+        system_time=sum(u.system_time for u in usages),
+        voluntary_switches=sum(u.voluntary_switches for u in usages),
+        involuntary_switches=sum(u.involuntary_switches for u in usages),
+        peak_rss=peak_rss,
+    )
+
+
+def share(usage, fraction):
+    """Attribute a *fraction* of the CPU time and context switches of
+    *usage*, e.g. to one of the queries of a mixed workload."""
+    return usage._replace(
+        user_time=usage.user_time * fraction,
+        system_time=usage.system_time * fraction,
+        voluntary_switches=round(usage.voluntary_switches * fraction),
+        involuntary_switches=round(usage.involuntary_switches * fraction),
+    )
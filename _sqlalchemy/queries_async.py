@@ -1,3 +1,4 @@
+import collections
 import json
 import random
 import sqlalchemy as sa
@@ -5,11 +6,27 @@ import sqlalchemy.ext.asyncio as sa_asyncio
 import sqlalchemy.orm as orm
 import _sqlalchemy.models as m
 
+import _idcache
+import _instrument
+from _postgres import sampling as pg_sampling
+from _postgres import snapshot as pg_snapshot
+from _postgres import stats as pg_stats
+
 
 engine = None
 session_factory = None
 ASYNC = True
 INSERT_PREFIX = "insert_test__"
+INSERT_MODELS = {"insert_user": m.User, "update_comments_on_answer": m.Comment}
+
+write_isolation = "none"
+# IDs of the rows inserted by each query, with bulk-delete isolation.
+inserted = collections.defaultdict(list)
+
+
+def init(ctx):
+    global write_isolation
+    write_isolation = ctx.write_isolation
 
 
 async def connect(ctx):
@@ -33,34 +50,74 @@ async def close(ctx, sess):
     await sess.bind.dispose()
 
 
-async def load_ids(ctx, sess):
-    users = ( await sess.scalars(
-        sa.select(m.User).order_by(sa.func.random()).limit(ctx.number_of_ids)
-    )).all()
+def raw_fetch(sess):
+    async def fetch(query):
+        try:
+            result = await sess.execute(sa.text(query))
+        except Exception:
+            await sess.rollback()
+            raise
+        return result.mappings().all()
+
+    return fetch
+
+
+async def server_stats(ctx, sess):
+    snapshot = await pg_stats.snapshot(raw_fetch(sess))
+    await sess.commit()
+    return snapshot
+
+
+server_stats_delta = pg_stats.delta
+
 
-    questions = (await sess.scalars(
-        sa.select(m.Question).order_by(sa.func.random()).limit(ctx.number_of_ids)
-    )).all()
+async def save_snapshot(ctx):
+    await pg_snapshot.save(ctx, "sqlalch_bench", owner="sqlalch_bench")
 
-    answers = (await sess.scalars(
-        sa.select(m.Answer).order_by(sa.func.random()).limit(ctx.number_of_ids)
-    )).all()
 
-    comments = (await sess.scalars(
-        sa.select(m.Comment).order_by(sa.func.random()).limit(ctx.number_of_ids)
-    )).all()
+async def restore_snapshot(ctx):
+    await pg_snapshot.restore(ctx, "sqlalch_bench", owner="sqlalch_bench")
+
+
+async def write(sess, queryname, obj):
+    if write_isolation == "rollback":
+        with _instrument.phase(_instrument.WAIT):
+            await sess.flush()
+        # The object keeps its attributes, including its ID.
+        with _instrument.phase(_instrument.ISOLATION):
+            await sess.rollback()
+        return
+
+    with _instrument.phase(_instrument.WAIT):
+        await sess.commit()
+    if write_isolation == "bulk-delete":
+        with _instrument.phase(_instrument.ISOLATION):
+            inserted[queryname].append(obj.id)
+
+
+async def load_ids(ctx, sess):
+    fetch = raw_fetch(sess)
+    pools = await _idcache.load_pools(
+        ctx,
+        "sqlalchemy",
+        await pg_sampling.fingerprint(fetch),
+        lambda rng: pg_sampling.sample(fetch, ctx.number_of_ids, rng),
+    )
+    users = pools["User"]
+    answers = pools["Answer"]
+    questions = pools["Question"]
 
     return dict(
-        get_answer=[a.id for a in answers],
-        get_comments_on_question=[q.id for q in questions],
+        get_answer=answers,
+        get_comments_on_question=questions,
         # generate as many insert stubs as "concurrency" to
         # accommodate concurrent inserts
         insert_user=[INSERT_PREFIX] * ctx.concurrency,
         update_comments_on_answer=[
             {
                 "prefix": INSERT_PREFIX,
-                "answer_id": [a.id for a in answers],
-                "author_id": [u.id for u in users],
+                "answer_id": answers,
+                "author_id": users,
             }
         ]
         * ctx.concurrency,
@@ -72,42 +129,48 @@ async def get_answer(sess, id):
     User = m.User
     Comment = m.Comment
 
-    stmt = (
-        sa.select(
-            Answer.content,
-            Answer.upvote,
-            Answer.downvote,
-            Answer.is_accepted,
-            User.email.label("author_email"),
-            User.username.label("author_username"),
-            Comment.content.label("comment_content"),
-            Comment.upvote.label("comment_upvote"),
-            Comment.downvote.label("comment_downvote"),
-            Comment.author_id.label("comment_author_id"),
+    with _instrument.phase(_instrument.ENCODE):
+        stmt = (
+            sa.select(
+                Answer.content,
+                Answer.upvote,
+                Answer.downvote,
+                Answer.is_accepted,
+                User.email.label("author_email"),
+                User.username.label("author_username"),
+                Comment.content.label("comment_content"),
+                Comment.upvote.label("comment_upvote"),
+                Comment.downvote.label("comment_downvote"),
+                Comment.author_id.label("comment_author_id"),
+            )
+            .select_from(Answer)
+            .join(User, Answer.author_id == User.id)
+            .outerjoin(Comment, Answer.id == Comment.answer_id)
+            .where(Answer.id == id)
         )
-        .select_from(Answer)
-        .join(User, Answer.author_id == User.id)
-        .outerjoin(Comment, Answer.id == Comment.answer_id)
-        .where(Answer.id == id)
-    )
 
-    result = (await sess.execute(stmt)).first()
+    with _instrument.phase(_instrument.WAIT):
+        rows = await sess.execute(stmt)
+
+    with _instrument.phase(_instrument.DECODE):
+        result = rows.first()
 
     if result is not None:
-        answer_details = json.dumps(
-            {
-                "content": result.content,
-                "upvote": result.upvote,
-                "downvote": result.downvote,
-                "is_accepted": result.is_accepted,
-                "author_email": result.author_email,
-                "author_username": result.author_username,
-                "comment_content": result.comment_content,
-                "comment_upvote": result.comment_upvote,
-                "comment_downvote": result.comment_downvote,
-                "comment_author_id": result.comment_author_id,
-            }
-        )
+        with _instrument.phase(_instrument.POSTPROCESS):
+            answer_details = json.dumps(
+                {
+                    "content": result.content,
+                    "upvote": result.upvote,
+                    "downvote": result.downvote,
+                    "is_accepted": result.is_accepted,
+                    "author_email": result.author_email,
+                    "author_username": result.author_username,
+                    "comment_content": result.comment_content,
+                    "comment_upvote": result.comment_upvote,
+                    "comment_downvote": result.comment_downvote,
+                    "comment_author_id": result.comment_author_id,
+                }
+            )
         return answer_details
     else:
         return None
@@ -118,66 +181,76 @@ async def get_comments_on_question(sess, id):
     Question = m.Question
     User = m.User
 
-    comments_ids = (
-        sa.select(Comment.id)
-        .join(Question, Question.id == Comment.question_id)
-        .where(Question.id == id)
-        .subquery()
-    )
+    with _instrument.phase(_instrument.ENCODE):
+        comments_ids = (
+            sa.select(Comment.id)
+            .join(Question, Question.id == Comment.question_id)
+            .where(Question.id == id)
+            .subquery()
+        )
 
-    stmt = (
-        sa.select(
-            Comment.content,
-            Comment.upvote,
-            Comment.downvote,
-            User.id.label("author_id"),
-            User.email.label("author_email"),
-            User.username.label("author_username"),
+        stmt = (
+            sa.select(
+                Comment.content,
+                Comment.upvote,
+                Comment.downvote,
+                User.id.label("author_id"),
+                User.email.label("author_email"),
+                User.username.label("author_username"),
+            )
+            .join(User, Comment.author_id == User.id)
+            .where(Comment.id.in_(comments_ids))
         )
-        .join(User, Comment.author_id == User.id)
-        .where(Comment.id.in_(comments_ids))
-    )
-    rows = await sess.execute(stmt)
 
-    comments_details = [
-        {
-            "content": row.content,
-            "upvote": row.upvote,
-            "downvote": row.downvote,
-            "author_id": row.author_id,
-            "author_email": row.author_email,
-            "author_username": row.author_username,
-        }
-        for row in rows.all()
-    ]
-    return json.dumps(comments_details)
+    with _instrument.phase(_instrument.WAIT):
+        rows = await sess.execute(stmt)
+
+    with _instrument.phase(_instrument.DECODE):
+        rows = rows.all()
+
+    with _instrument.phase(_instrument.POSTPROCESS):
+        comments_details = [
+            {
+                "content": row.content,
+                "upvote": row.upvote,
+                "downvote": row.downvote,
+                "author_id": row.author_id,
+                "author_email": row.author_email,
+                "author_username": row.author_username,
+            }
+            for row in rows
+        ]
+        return json.dumps(comments_details)
 
 
 
 async def insert_user(sess, val):
     User = m.User
 
-    new_user = User(
-        age=random.randint(10, 100),
-        email=f"{val}@test.com",
-        first_name=f"{val}First",
-        last_name=f"{val}Last",
-        username=f"{val}Username",
-        hashed_password=f"{val}Password",
-    )
+    with _instrument.phase(_instrument.ENCODE):
+        new_user = User(
+            age=random.randint(10, 100),
+            email=f"{val}@test.com",
+            first_name=f"{val}First",
+            last_name=f"{val}Last",
+            username=f"{val}Username",
+            hashed_password=f"{val}Password",
+        )
 
-    sess.add(new_user)
-    await sess.commit()
+        sess.add(new_user)
 
-    result = json.dumps(
-        {
-            "id": new_user.id,
-            "username": new_user.username,
-            "email": new_user.email,
-            "first_name": new_user.first_name,
-            "last_name": new_user.last_name,
-        }
-    )
+    await write(sess, "insert_user", new_user)
+
+    with _instrument.phase(_instrument.POSTPROCESS):
+        result = json.dumps(
+            {
+                "id": new_user.id,
+                "username": new_user.username,
+                "email": new_user.email,
+                "first_name": new_user.first_name,
+                "last_name": new_user.last_name,
+            }
+        )
     return result
 
 
@@ -187,33 +260,48 @@ async def update_comments_on_answer(sess, val):
 
     Comment = m.Comment
 
-    new_comment = Comment(
-        upvote=num,
-        downvote=num // 10,
-        content=f"{val['prefix']}{num}",
-        author_id=random.choice(val["author_id"]),
-        answer_id=random.choice(val["answer_id"]),
-    )
+    with _instrument.phase(_instrument.ENCODE):
+        new_comment = Comment(
+            upvote=num,
+            downvote=num // 10,
+            content=f"{val['prefix']}{num}",
+            author_id=random.choice(val["author_id"]),
+            answer_id=random.choice(val["answer_id"]),
+        )
 
-    sess.add(new_comment)
-    await sess.commit()
+        sess.add(new_comment)
 
-    result = json.dumps(
-        {
-            "id": new_comment.id,
-            "upvote": new_comment.upvote,
-            "downvote": new_comment.downvote,
-            "content": new_comment.content,
-            "author_id": new_comment.author_id,
-            "answer_id": new_comment.answer_id,
-        }
-    )
+    await write(sess, "update_comments_on_answer", new_comment)
+
+    with _instrument.phase(_instrument.POSTPROCESS):
+        result = json.dumps(
+            {
+                "id": new_comment.id,
+                "upvote": new_comment.upvote,
+                "downvote": new_comment.downvote,
+                "content": new_comment.content,
+                "author_id": new_comment.author_id,
+                "answer_id": new_comment.answer_id,
+            }
+        )
     return result
 
 
 
 async def cleanup(ctx, sess, queryname):
-    if queryname == "insert_user":
+    if write_isolation == "rollback":
+        # Nothing was left behind.
+        return
+    elif write_isolation == "bulk-delete":
+        ids = inserted.pop(queryname, None)
+        if ids:
+            model = INSERT_MODELS[queryname]
+            await sess.execute(
+                sa.delete(model)
+                .where(model.id.in_(ids))
+                .execution_options(synchronize_session=False)
+            )
+    elif queryname == "insert_user":
         await sess.execute(
             sa.delete(m.User)
             .where(m.User.username.like(f"{INSERT_PREFIX}%"))
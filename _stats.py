@@ -0,0 +1,131 @@
+import math
+
+import numpy as np
+
+
+def find_knee(points, threshold=0.1):
+    """Find the knee of a throughput/latency curve.
+
+    *points* are ``(qps, latency)`` pairs measured at increasing
+    concurrency levels.  The knee is the last level after which
+    throughput grows by less than *threshold* (relative) while latency
+    grows by more than that.  Returns its index, or None if throughput
+    was still rising at the last level.
+    """
+    for i in range(1, len(points)):
+        prev_qps, prev_lat = points[i - 1]
+        qps, lat = points[i]
+        qps_gain = qps / prev_qps - 1 if prev_qps else float('inf')
+        lat_growth = lat / prev_lat - 1 if prev_lat else 0.0
+        if qps_gain < threshold and lat_growth > threshold:
+            return i - 1
+    return None
+
+
+def is_steady(windows, count, tolerance):
+    """Tell if the last *count* *windows* agree within *tolerance*.
+
+    Every window is a tuple of metrics (e.g. throughput and latency).
+    They agree when the range of each metric is at most *tolerance* of
+    its mean.
+    """
+    if len(windows) < count:
+        return False
+    for values in zip(*windows[-count:]):
+        mean = sum(values) / len(values)
+        if not mean or (max(values) - min(values)) / mean > tolerance:
+            return False
+    return True
+
+
+def bootstrap_ci(histograms, interval, percentiles, *, confidence=0.95,
+                 nresamples=1000, seed=None):
+    """Bootstrap confidence intervals of throughput and latency percentiles.
+
+    *histograms* are the per-interval latency histograms of a run (or of
+    several repeated runs), each covering *interval* seconds.  Intervals
+    are resampled with replacement, and the throughput and the latency
+    *percentiles* of every resample are computed from the merged counts.
+
+    Intervals in which nothing completed count towards the throughput
+    (a stall is what it should show) but have no latencies, so
+    resamples of only such intervals are left out of the percentiles.
+
+    Returns ``(qps_ci, percentile_cis)`` with ``(low, high)`` pairs, in
+    queries per second and in the unit of the histograms.
+    """
+    nonempty = [h for h in histograms if h.total]
+    if len(histograms) < 2 or not nonempty:
+        return None, None
+
+    indexes = sorted(set().union(*(h.counts for h in nonempty)))
+    values = np.array(
+        [nonempty[0].highest_equivalent(idx) for idx in indexes],
+        dtype=np.float64)
+    column = {idx: i for i, idx in enumerate(indexes)}
+    counts = np.zeros((len(histograms), len(indexes)))
+    for row, hist in enumerate(histograms):
+        for idx, count in hist.counts.items():
+            counts[row, column[idx]] = count
+
+    n = len(histograms)
+    rng = np.random.default_rng(seed)
+    # How many times every interval is picked in each resample.
+    weights = rng.multinomial(n, np.full(n, 1 / n), size=nresamples)
+    resampled = weights @ counts
+    totals = resampled.sum(axis=1)
+    cumulative = np.cumsum(resampled, axis=1)
+
+    alpha = (1 - confidence) / 2 * 100
+    bounds = [alpha, 100 - alpha]
+
+    qps = totals / (n * interval)
+    qps_ci = tuple(np.percentile(qps, bounds).tolist())
+
+    measured = totals > 0
+    totals = totals[measured]
+    cumulative = cumulative[measured]
+
+    percentile_cis = []
+    for p in percentiles:
+        targets = np.maximum(np.ceil(p / 100 * totals), 1)
+        pos = (cumulative < targets[:, None]).sum(axis=1)
+        pvalues = values[np.minimum(pos, len(values) - 1)]
+        percentile_cis.append(tuple(np.percentile(pvalues, bounds).tolist()))
+
+    return qps_ci, percentile_cis
+
+
+def relative_ci_width(ci, estimate):
+    if ci is None or not estimate:
+        return float('inf')
+    return (ci[1] - ci[0]) / estimate
+
+
+def mann_whitney_u(x, y):
+    """Two-sided Mann-Whitney U test of two independent samples.
+
+    Uses the normal approximation with tie and continuity corrections,
+    which is adequate for the tens of per-interval values of a run.
+    Returns ``(u, pvalue)``, where *u* is the statistic of *x*.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n1, n2 = len(x), len(y)
+    if not n1 or not n2:
+        return None, 1.0
+
+    _, inverse, counts = np.unique(
+        np.concatenate([x, y]), return_inverse=True, return_counts=True)
+    # The average rank of every distinct value.
+    ranks = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+    u = ranks[:n1].sum() - n1 * (n1 + 1) / 2
+
+    n = n1 + n2
+    ties = (counts ** 3 - counts).sum()
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return float(u), 1.0
+
+    z = max(abs(u - n1 * n2 / 2) - 0.5, 0) / math.sqrt(variance)
+    return float(u), min(math.erfc(z / math.sqrt(2)), 1.0)
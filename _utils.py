@@ -1,30 +1,79 @@
 import argparse
+import importlib
+import importlib.metadata
+import json
+import os
 import sys
 import types
 import typing
 
 
-from _edgedb import queries_async as edgedb_queries_async
-from _postgres import queries_async as postgres_queries_async
-from _sqlalchemy import queries_async as sqlalchemy_queries_async
-
-
 class impl(typing.NamedTuple):
     language: str
     title: str
-    module: typing.Optional[types.ModuleType]
+    module_name: typing.Optional[str]
+
+    @property
+    def module(self) -> typing.Optional[types.ModuleType]:
+        # Implementation modules pull in their database drivers, so they
+        # are only imported once their benchmark is actually run.
+        if self.module_name is None:
+            return None
+        return importlib.import_module(self.module_name)
 
 
 IMPLEMENTATIONS = {
-    "edgedb_py_async": impl("python", "EdgeDB", edgedb_queries_async),
-    "postgres_py_async": impl("python", "PostgreSQL", postgres_queries_async),
-    "sqlalchemy_async": impl("python", "SQLAlchemy", sqlalchemy_queries_async),
+    "edgedb_py_async": impl("python", "EdgeDB", "_edgedb.queries_async"),
+    "postgres_py_async": impl("python", "PostgreSQL", "_postgres.queries_async"),
+    "sqlalchemy_async": impl("python", "SQLAlchemy", "_sqlalchemy.queries_async"),
 }
 
+# Entry point group through which installed packages can register
+# additional implementations.  The entry point name is the benchmark
+# name and its value is the module implementing the queries.
+IMPLEMENTATIONS_ENTRY_POINTS = "qnabench.implementations"
+
+# Environment variable with a list of JSON files (separated by
+# os.pathsep) that register additional implementations as
+# {"name": {"title": ..., "module": ..., "language": "python"}}.
+IMPLEMENTATIONS_ENV = "QNABENCH_IMPLEMENTATIONS"
+
+
+def register_implementation(name, *, title, module, language="python"):
+    IMPLEMENTATIONS[name] = impl(language, title, module)
+
+
+def _load_registered_implementations():
+    eps = importlib.metadata.entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group=IMPLEMENTATIONS_ENTRY_POINTS)
+    else:
+        # Python < 3.10
+        eps = eps.get(IMPLEMENTATIONS_ENTRY_POINTS, [])
+    for ep in eps:
+        register_implementation(ep.name, title=ep.name, module=ep.value)
+
+    for path in os.environ.get(IMPLEMENTATIONS_ENV, "").split(os.pathsep):
+        if not path:
+            continue
+        with open(path) as f:
+            for name, desc in json.load(f).items():
+                register_implementation(
+                    name,
+                    title=desc.get("title", name),
+                    module=desc["module"],
+                    language=desc.get("language", "python"),
+                )
+
+
+_load_registered_implementations()
+
 
 class bench(typing.NamedTuple):
     title: str
     description: str
+    # The query changes the dataset.
+    writes: bool = False
 
 
 BENCHMARKS = {
@@ -39,14 +88,55 @@ BENCHMARKS = {
         title="GET /comment/:question_id",
         description="Get all comments on a given question.",
     ),
-    "insert_user": bench(title="POST /user", description="Insert a new user."),
+    "insert_user": bench(
+        title="POST /user", description="Insert a new user.", writes=True
+    ),
     "update_comments_on_answer": bench(
         title="PATCH /answer/:id",
         description="Update the comments on a given answer (add a new comment to exisiting comments).",
+        writes=True,
     ),
 }
 
 
+def parse_concurrency_sweep(value):
+    if value == "auto":
+        return value
+    try:
+        levels = sorted({int(v) for v in value.split(",")})
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid concurrency levels: {value!r}"
+        ) from None
+    if levels[0] < 1:
+        raise argparse.ArgumentTypeError("concurrency levels must be positive")
+    return levels
+
+
+# Name of the aggregate result of a mixed workload (see --mix).
+MIXED_WORKLOAD = "mix"
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        queryname, _, weight = item.partition("=")
+        queryname = queryname.strip()
+        if queryname not in BENCHMARKS:
+            raise argparse.ArgumentTypeError(f"unknown query: {queryname!r}")
+        try:
+            mix[queryname] = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"invalid weight for {queryname}: {weight!r}"
+            ) from None
+        if mix[queryname] <= 0:
+            raise argparse.ArgumentTypeError(
+                f"weight of {queryname} must be positive"
+            )
+    return mix
+
+
 def parse_args(*, prog_desc: str, out_to_json: bool = False, out_to_html: bool = False):
     parser = argparse.ArgumentParser(
         description=prog_desc, formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -60,6 +150,23 @@ def parse_args(*, prog_desc: str, out_to_json: bool = False, out_to_html: bool =
         help="number of concurrent connections",
     )
 
+    parser.add_argument(
+        "--concurrency-sweep",
+        type=parse_concurrency_sweep,
+        default=None,
+        help="comma-separated list of concurrency levels to run every "
+        "query at, or 'auto' to keep doubling the concurrency from 1 up to "
+        "--concurrency until the throughput/latency knee is found",
+    )
+
+    parser.add_argument(
+        "--knee-threshold",
+        type=float,
+        default=0.1,
+        help="relative throughput gain below which (with latency growing "
+        "faster) a concurrency sweep has reached its knee",
+    )
+
     parser.add_argument(
         "--async-split",
         type=int,
@@ -77,17 +184,129 @@ def parse_args(*, prog_desc: str, out_to_json: bool = False, out_to_html: bool =
     parser.add_argument(
         "--timeout", default=2, type=int, help="server timeout in seconds"
     )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="minimum number of consecutive measurements of --duration "
+        "seconds taken for every query",
+    )
+    parser.add_argument(
+        "--target-ci",
+        type=float,
+        default=0,
+        help="keep measuring until the 95%% confidence intervals of "
+        "throughput and p99 latency are narrower than this fraction of "
+        "the estimate (e.g. 0.05); 0 disables",
+    )
+    parser.add_argument(
+        "--max-duration",
+        type=int,
+        default=None,
+        help="limit in seconds of the measurement of a query when "
+        "--target-ci is set (default: 10 times --duration)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="length in seconds of the intervals reported in the time series",
+    )
     parser.add_argument(
         "--warmup-time",
         type=int,
         default=5,
-        help="duration of warmup period for each benchmark in seconds",
+        help="duration of warmup period for each benchmark in seconds "
+        "(the limit with --adaptive-warmup)",
+    )
+    parser.add_argument(
+        "--adaptive-warmup",
+        action="store_true",
+        help="end the warmup once throughput and latency are steady",
+    )
+    parser.add_argument(
+        "--warmup-window",
+        type=float,
+        default=1.0,
+        help="length in seconds of the windows compared by --adaptive-warmup",
+    )
+    parser.add_argument(
+        "--warmup-windows",
+        type=int,
+        default=3,
+        help="number of consecutive windows that must agree for the "
+        "warmup to end",
+    )
+    parser.add_argument(
+        "--warmup-tolerance",
+        type=float,
+        default=0.05,
+        help="relative range within which the throughput and the mean "
+        "latency of the windows must be to be steady",
     )
     parser.add_argument(
         "--net-latency",
         default=0,
+        type=float,
+        help="roundtrip latency in milliseconds between a database and a "
+        "client, injected by a local proxy; round trips take up to about "
+        "0.15 ms longer, the time of the loopback and the proxy",
+    )
+    parser.add_argument(
+        "--net-jitter",
+        default=0,
+        type=float,
+        help="variation in milliseconds of the latency of every packet in "
+        "each direction (see --net-delay-dist)",
+    )
+    parser.add_argument(
+        "--net-delay-dist",
+        choices=["constant", "uniform", "normal", "pareto"],
+        default="normal",
+        help="distribution of packet delays: the jitter is the half-width "
+        "of a uniform, the standard deviation of a normal, or the mean extra "
+        "delay of a pareto distribution",
+    )
+    parser.add_argument(
+        "--net-bandwidth",
+        default=0,
+        type=float,
+        help="bandwidth in Mbit/s of the simulated link in each direction; "
+        "0 is unlimited",
+    )
+    parser.add_argument(
+        "--no-net-proxy",
+        dest="net_proxy",
+        action="store_false",
+        help="do not inject the network conditions and only record "
+        "--net-latency in the report, e.g. for a database on another host",
+    )
+    parser.add_argument(
+        "--latency-digits",
+        type=int,
+        default=3,
+        choices=range(1, 6),
+        metavar="{1..5}",
+        help="number of significant digits kept in latency histograms",
+    )
+    parser.add_argument(
+        "--latency-resolution",
         type=int,
-        help="assumed p0 roundtrip latency between a database and a client",
+        default=1000,
+        help="lowest discernible latency value in nanoseconds",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="target request rate in queries per second (across all "
+        "connections) for open-loop mode; 0 runs a closed loop",
+    )
+    parser.add_argument(
+        "--arrival",
+        choices=["constant", "poisson"],
+        default="constant",
+        help="distribution of request arrivals in open-loop mode",
     )
     parser.add_argument(
         "--pg-port", type=int, default=3500, help="PostgreSQL server port"
@@ -108,6 +327,70 @@ def parse_args(*, prog_desc: str, out_to_json: bool = False, out_to_html: bool =
         help="number of random IDs to fetch data with in benchmarks",
     )
 
+    parser.add_argument(
+        "--write-isolation",
+        choices=["none", "rollback", "bulk-delete"],
+        default="none",
+        help="keep write queries from changing the dataset: rollback runs "
+        "every write in a transaction that is rolled back, bulk-delete "
+        "deletes the inserted rows by primary key after the benchmark; "
+        "by default they are deleted by a scan for their prefix",
+    )
+
+    parser.add_argument(
+        "--reset",
+        action="store_true",
+        help="restore the snapshot of the dataset (see snapshot.py) before "
+        "the benchmarks and after every workload that writes, instead of "
+        "cleaning up after it",
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the random sample of IDs used by the benchmarks",
+    )
+
+    parser.add_argument(
+        "--ids-cache",
+        default=os.path.join(os.path.dirname(__file__), ".ids_cache"),
+        help="directory where sampled IDs are kept for later runs on the "
+        "same data (an empty string disables the cache)",
+    )
+
+    parser.add_argument(
+        "--key-dist",
+        choices=["shuffle", "uniform", "zipf", "hotspot", "sequential"],
+        default="shuffle",
+        help="distribution of the IDs accessed by the queries: shuffle "
+        "cycles through the IDs of every connection in random order, "
+        "the others draw from the IDs shared by all connections",
+    )
+
+    parser.add_argument(
+        "--zipf-s",
+        type=float,
+        default=1.0,
+        help="skew of the zipf key distribution",
+    )
+
+    parser.add_argument(
+        "--hot-keys",
+        type=float,
+        default=0.2,
+        help="fraction of the IDs that are hot in the hotspot key "
+        "distribution",
+    )
+
+    parser.add_argument(
+        "--hot-traffic",
+        type=float,
+        default=0.8,
+        help="fraction of the requests going to the hot IDs in the hotspot "
+        "key distribution",
+    )
+
     parser.add_argument(
         "--query",
         dest="queries",
@@ -116,6 +399,36 @@ def parse_args(*, prog_desc: str, out_to_json: bool = False, out_to_html: bool =
         choices=list(BENCHMARKS.keys()) + ["all"],
     )
 
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=None,
+        help="run a weighted mix of queries concurrently instead of each "
+        "query on its own, e.g. get_answer=70,insert_user=30",
+    )
+
+    parser.add_argument(
+        "--measure-startup",
+        action="store_true",
+        help="report the time each implementation takes to import its "
+        "module and to connect, measured in a fresh process",
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default="",
+        help="directory to write collapsed stacks (for flame graph tools) "
+        "of the async workers, sampled during the measurements",
+    )
+
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=5.0,
+        help="interval in milliseconds between profile samples",
+    )
+
     parser.add_argument(
         "benchmarks",
         nargs="+",
@@ -139,13 +452,72 @@ def parse_args(*, prog_desc: str, out_to_json: bool = False, out_to_html: bool =
     args = parser.parse_args()
     argv = sys.argv[1:]
 
-    if not args.queries:
+    if args.mix:
+        args.queries = list(args.mix)
+    elif not args.queries:
         args.queries = list(BENCHMARKS.keys())
 
-    if args.concurrency % args.async_split != 0:
-        raise Exception(
-            "'--concurrency' must be an integer multiple of '--async-split'"
-        )
+    args.stop_at_knee = args.concurrency_sweep == "auto"
+    if args.concurrency_sweep == "auto":
+        levels = []
+        level = 1
+        while level < args.concurrency:
+            levels.append(level)
+            level *= 2
+        args.concurrency_levels = levels + [args.concurrency]
+    elif args.concurrency_sweep:
+        args.concurrency_levels = args.concurrency_sweep
+        # Connections are opened for the highest level of the sweep.
+        args.concurrency = args.concurrency_levels[-1]
+    else:
+        args.concurrency_levels = [args.concurrency]
+        if args.concurrency % args.async_split != 0:
+            raise Exception(
+                "'--concurrency' must be an integer multiple of '--async-split'"
+            )
+
+    if args.interval <= 0:
+        raise Exception("'--interval' must be positive")
+
+    if args.net_latency < 0 or args.net_jitter < 0 or args.net_bandwidth < 0:
+        raise Exception("network conditions must not be negative")
+
+    args.net_proxy = args.net_proxy and bool(
+        args.net_latency or args.net_jitter or args.net_bandwidth
+    )
+
+    if args.warmup_window <= 0:
+        raise Exception("'--warmup-window' must be positive")
+
+    if args.warmup_windows < 2:
+        raise Exception("'--warmup-windows' must be at least 2")
+
+    if args.profile_interval <= 0:
+        raise Exception("'--profile-interval' must be positive")
+
+    if args.repeat < 1:
+        raise Exception("'--repeat' must be at least 1")
+
+    if args.target_ci < 0:
+        raise Exception("'--target-ci' must not be negative")
+
+    if args.max_duration is None:
+        args.max_duration = args.duration * 10
+
+    if args.latency_resolution < 1:
+        raise Exception("'--latency-resolution' must be at least 1ns")
+
+    if args.rate < 0:
+        raise Exception("'--rate' must not be negative")
+
+    if args.zipf_s < 0:
+        raise Exception("'--zipf-s' must not be negative")
+
+    if not 0 < args.hot_keys <= 1:
+        raise Exception("'--hot-keys' must be in (0, 1]")
+
+    if not 0 <= args.hot_traffic <= 1:
+        raise Exception("'--hot-traffic' must be in [0, 1]")
 
     if "all" in args.benchmarks:
         args.benchmarks = list(IMPLEMENTATIONS.keys())
@@ -11,7 +11,6 @@
 import datetime
 import itertools
 import json
-import math
 import os
 import os.path
 import pathlib
@@ -23,8 +22,11 @@ import sys
 
 import distro
 import jinja2
-import numpy as np
 
+import _histogram
+import _keydist
+import _profiler
+import _stats
 import _utils
 
 
@@ -58,47 +60,90 @@ def platform_info():
     return data
 
 
-def weighted_quantile(values, quantiles, weights):
-    """Very close to np.percentile, but supports weights.
-
-    :param values: np.array with data
-    :param quantiles: array-like with many quantiles needed,
-           quantiles should be in [0, 1]!
-    :param weights: array-like of the same length as `array`
-    :return: np.array with computed quantiles.
-    """
-    values = np.array(values)
-    quantiles = np.array(quantiles)
-    weights = np.array(weights)
-    if not (np.all(quantiles >= 0) and np.all(quantiles <= 1)):
-        raise ValueError('quantiles should be in [0, 1]')
-
-    weighted_quantiles = np.cumsum(weights) - 0.5 * weights
-    weighted_quantiles -= weighted_quantiles[0]
-    weighted_quantiles /= weighted_quantiles[-1]
-
-    return np.interp(quantiles, weighted_quantiles, values)
+percentiles = [25, 50, 75, 90, 99, 99.99]
 
 
-percentiles = [25, 50, 75, 90, 99, 99.99]
+def calc_timeseries(histograms, interval):
+    series = dict(interval=interval, qps=[], p50=[], p99=[])
+    for hist in histograms:
+        p50, p99 = hist.percentiles([50, 99])
+        series['qps'].append(round(hist.total / interval, 2))
+        series['p50'].append(round(p50 / 1e6, 3))
+        series['p99'].append(round(p99 / 1e6, 3))
+    return series
 
 
 def calc_latency_stats(queries, duration, min_latency, max_latency,
-                       latency_stats, samples, *, output_format='text'):
-    arange = np.arange(len(latency_stats))
-
-    mean_latency = np.average(arange, weights=latency_stats)
-    variance = np.average((arange - mean_latency) ** 2, weights=latency_stats)
-    latency_std = math.sqrt(variance)
-    latency_cv = latency_std / mean_latency
+                       latency_stats, samples, nlate=0, timeseries=None,
+                       interval=None, trials=1, warmup=None, phases=None,
+                       profile=None, profile_overhead=None, resources=None,
+                       server=None, *, output_format='text'):
+    # Latencies come in nanoseconds and are reported in milliseconds.
+    mean_latency = latency_stats.mean()
+    latency_std = latency_stats.stddev()
+    latency_cv = latency_std / mean_latency if mean_latency else 0.0
 
     percentile_data = []
 
-    quantiles = weighted_quantile(arange, [p / 100 for p in percentiles],
-                                  weights=latency_stats)
+    quantiles = latency_stats.percentiles(percentiles)
 
     for i, percentile in enumerate(percentiles):
-        percentile_data.append((percentile, round(quantiles[i] / 100, 3)))
+        percentile_data.append((percentile, round(quantiles[i] / 1e6, 3)))
+
+    qps_ci = percentile_ci = None
+    if timeseries and interval:
+        # 95% confidence intervals, bootstrapped over the time series.
+        qps_ci, cis = _stats.bootstrap_ci(timeseries, interval, percentiles)
+        if qps_ci is not None:
+            qps_ci = [round(v, 2) for v in qps_ci]
+            percentile_ci = [
+                (percentile, round(low / 1e6, 3), round(high / 1e6, 3))
+                for percentile, (low, high) in zip(percentiles, cis)
+            ]
+
+    phase_data = None
+    if phases:
+        total = sum(hist.sum for hist in phases.values())
+        phase_data = []
+        for name, hist in phases.items():
+            p50, p99 = hist.percentiles([50, 99])
+            phase_data.append(dict(
+                phase=name,
+                mean=round(hist.mean() / 1e6, 3),
+                p50=round(p50 / 1e6, 3),
+                p99=round(p99 / 1e6, 3),
+                share=round(hist.sum / total * 100, 1) if total else 0.0,
+            ))
+
+    client_data = None
+    if resources:
+        cpu_time = resources['user_time'] + resources['system_time']
+        nqueries = max(queries, 1)
+        client_data = dict(
+            cpu_us_per_query=round(cpu_time / nqueries * 1e6, 1),
+            cpu_utilization=round(cpu_time / duration * 100, 1),
+            peak_rss_mib=round(resources['peak_rss'] / 2 ** 20, 1),
+            voluntary_switches_per_query=round(
+                resources['voluntary_switches'] / nqueries, 3),
+            involuntary_switches_per_query=round(
+                resources['involuntary_switches'] / nqueries, 3),
+        )
+
+    server_data = None
+    if server:
+        server_data = calc_server_stats(server, queries, mean_latency / 1e6)
+
+    profile_data = None
+    if profile and os.path.exists(profile):
+        profile_data = dict(
+            filename=profile,
+            overhead=round(profile_overhead * 100, 2),
+            top=[
+                (frame, round(share * 100, 1))
+                for frame, share in _profiler.top_frames(
+                    _profiler.read_collapsed(profile))
+            ],
+        )
 
     if samples:
         random.shuffle(samples)
@@ -108,18 +153,89 @@ def calc_latency_stats(queries, duration, min_latency, max_latency,
         duration=round(duration, 2),
         queries=queries,
         qps=round(queries / duration, 2),
-        latency_min=round(min_latency / 100, 3),
-        latency_mean=round(mean_latency / 100, 3),
-        latency_max=round(max_latency / 100, 3),
-        latency_std=round(latency_std / 100, 3),
+        qps_ci=qps_ci,
+        trials=trials,
+        warmup=warmup,
+        latency_min=round(min_latency / 1e6, 3),
+        latency_mean=round(mean_latency / 1e6, 3),
+        latency_max=round(max_latency / 1e6, 3),
+        latency_std=round(latency_std / 1e6, 3),
         latency_cv=round(latency_cv * 100, 2),
         latency_percentiles=percentile_data,
+        latency_percentiles_ci=percentile_ci,
+        phases=phase_data,
+        profile=profile_data,
+        client=client_data,
+        server=server_data,
+        late_requests=nlate,
+        timeseries=(
+            calc_timeseries(timeseries, interval) if timeseries else None
+        ),
         samples=samples[:3] if samples else None
     )
 
     return data
 
 
+def calc_server_stats(server, queries, latency_mean):
+    # The activity of the database server per query of the benchmark
+    # (statements, blocks and rows are counted by the server, a query of
+    # the benchmark may run several statements).
+    nqueries = max(queries, 1)
+    data = dict(
+        server_time_per_query=None,
+        client_time_per_query=None,
+        statements_per_query=None,
+        rows_per_query=None,
+        buffer_hit_ratio=None,
+        blocks_read_per_query=None,
+        temp_blocks_per_query=None,
+        wal_bytes_per_query=None,
+        top_statements=None,
+    )
+
+    statements = server.get('statements')
+    if statements:
+        server_time = statements['exec_time'] / nqueries
+        blocks = statements['shared_blks_hit'] + statements['shared_blks_read']
+        data.update(
+            server_time_per_query=round(server_time, 3),
+            # Everything else: network, protocol, driver and Python.
+            client_time_per_query=round(
+                max(latency_mean - server_time, 0), 3),
+            statements_per_query=round(statements['calls'] / nqueries, 3),
+            rows_per_query=round(statements['rows'] / nqueries, 3),
+            buffer_hit_ratio=round(
+                statements['shared_blks_hit'] / blocks * 100, 2)
+            if blocks else None,
+            blocks_read_per_query=round(
+                statements['shared_blks_read'] / nqueries, 3),
+            temp_blocks_per_query=round(
+                (statements['temp_blks_read'] +
+                 statements['temp_blks_written']) / nqueries, 3),
+            top_statements=statements['top'],
+        )
+    elif server.get('database'):
+        database = server['database']
+        blocks = database['blks_hit'] + database['blks_read']
+        data.update(
+            rows_per_query=round(
+                (database['tup_returned'] + database['tup_inserted'] +
+                 database['tup_updated'] + database['tup_deleted']) /
+                nqueries, 3),
+            buffer_hit_ratio=round(
+                database['blks_hit'] / blocks * 100, 2)
+            if blocks else None,
+            blocks_read_per_query=round(database['blks_read'] / nqueries, 3),
+        )
+
+    if server.get('wal_bytes') is not None:
+        data['wal_bytes_per_query'] = round(
+            server['wal_bytes'] / nqueries, 1)
+
+    return data
+
+
 def _geom_mean(values):
     p = 1
     root = 0
@@ -133,9 +249,41 @@ def _geom_mean(values):
         return 0
 
 
+def _mean_ci(cis, ndigits):
+    cis = list(cis)
+    if not cis or any(ci is None for ci in cis):
+        return None
+    return [
+        round(_geom_mean(ci[0] for ci in cis), ndigits),
+        round(_geom_mean(ci[1] for ci in cis), ndigits),
+    ]
+
+
+def _mean_percentile_ci(var):
+    if any(v['latency_percentiles_ci'] is None for v in var):
+        return None
+    return [
+        (p, *_mean_ci((v['latency_percentiles_ci'][i][1:] for v in var), 3))
+        for i, p in enumerate(percentiles)
+    ]
+
+
+def _mean_client(var):
+    if any(v['client'] is None for v in var):
+        return None
+    return {
+        key: round(_geom_mean(v['client'][key] for v in var), 3)
+        for key in var[0]['client']
+    }
+
+
 def mean_latency_stats(data):
     pivot = {}
-    for bench in itertools.chain.from_iterable(data.values()):
+    # The aggregate of a mixed workload would count its queries twice.
+    per_query = (
+        v for k, v in data.items() if k != _utils.MIXED_WORKLOAD
+    )
+    for bench in itertools.chain.from_iterable(per_query):
         pivot.setdefault(bench["implementation"], []).append(bench)
 
     mean_data = []
@@ -146,6 +294,9 @@ def mean_latency_stats(data):
             duration=round(_geom_mean(v['duration'] for v in var), 2),
             queries=round(_geom_mean(v['queries'] for v in var), 2),
             qps=round(_geom_mean(v['qps'] for v in var), 2),
+            qps_ci=_mean_ci((v['qps_ci'] for v in var), 2),
+            trials=min(v['trials'] for v in var),
+            warmup=round(_geom_mean(v['warmup'] for v in var), 2),
             latency_min=round(_geom_mean(v['latency_min'] for v in var), 3),
             latency_mean=round(_geom_mean(v['latency_mean'] for v in var), 3),
             latency_max=round(_geom_mean(v['latency_max'] for v in var), 3),
@@ -161,32 +312,86 @@ def mean_latency_stats(data):
                         3
                     )
                 ) for i, p in enumerate(percentiles)
-            ]
+            ],
+            latency_percentiles_ci=_mean_percentile_ci(var),
+            client=_mean_client(var),
         ))
 
     return {'mean': mean_data, **data}
 
 
-def process_results(lat_data, results):
+def process_results(lat_data, results, sweeps):
     for bench_data in lat_data['data']:
         impl_name = bench_data['benchmark']
         impl = _utils.IMPLEMENTATIONS[impl_name]
 
+        by_query = {}
         for query_bench in bench_data['queries']:
             d = calc_latency_stats(
                 query_bench['nqueries'],
-                bench_data['duration'],
+                query_bench.get('duration', bench_data['duration']),
                 query_bench['min_latency'],
                 query_bench['max_latency'],
-                np.array(query_bench['latency_stats']),
-                query_bench.get('samples'))
+                _histogram.Histogram.from_dict(query_bench['latency_stats']),
+                query_bench.get('samples'),
+                query_bench.get('nlate', 0),
+                [
+                    _histogram.Histogram.from_dict(h)
+                    for h in query_bench.get('timeseries', [])
+                ],
+                lat_data.get('interval'),
+                query_bench.get('trials', 1),
+                query_bench.get('warmup', lat_data.get('warmup_time')),
+                {
+                    name: _histogram.Histogram.from_dict(h)
+                    for name, h in query_bench.get('phases', {}).items()
+                },
+                query_bench.get('profile'),
+                query_bench.get('profile_overhead'),
+                query_bench.get('resources'),
+                query_bench.get('server'))
 
             d["implementation"] = impl.title
-
-            results.setdefault(query_bench['queryname'], []).append(d)
-
-
-def format_report_html(data, target_file):
+            d["concurrency"] = query_bench.get(
+                'concurrency', lat_data['concurrency'])
+
+            by_query.setdefault(query_bench['queryname'], []).append(d)
+
+        for queryname, levels in by_query.items():
+            if len(levels) > 1:
+                # A concurrency sweep: the charts of the query show the
+                # knee of the curve (or the highest level, if there was
+                # no knee), and the whole curve is plotted separately.
+                knee = _stats.find_knee(
+                    [(d['qps'], _percentile(d, 99)) for d in levels],
+                    lat_data.get('knee_threshold', 0.1))
+                sweeps.setdefault(queryname, []).append(dict(
+                    implementation=impl.title,
+                    knee=levels[knee]['concurrency'] if knee is not None
+                    else None,
+                    points=[
+                        dict(
+                            concurrency=d['concurrency'],
+                            qps=d['qps'],
+                            p50=_percentile(d, 50),
+                            p99=_percentile(d, 99),
+                            timeseries=d['timeseries'],
+                        )
+                        for d in levels
+                    ],
+                ))
+                d = levels[knee if knee is not None else -1]
+            else:
+                d = levels[0]
+
+            results.setdefault(queryname, []).append(d)
+
+
+def _percentile(stats, percentile):
+    return dict(stats['latency_percentiles'])[percentile]
+
+
+def format_report_html(data, target_file, comparison=None):
     tpl_dir = pathlib.Path(__file__).parent / 'docs'
     tpl_path = tpl_dir / 'TEMPLATE.html'
 
@@ -207,14 +412,30 @@ def format_report_html(data, target_file):
     params = dict(
         __BENCHMARK_DATE__=data['date'],
         __BENCHMARK_DURATION__=data['duration'],
+        __BENCHMARK_WARMUP_TIME__=data['warmup_time'],
+        __BENCHMARK_ADAPTIVE_WARMUP__=data['adaptive_warmup'],
+        __BENCHMARK_REPEAT__=data['repeat'],
+        __BENCHMARK_TARGET_CI__=data['target_ci'],
         __BENCHMARK_CONCURRENCY__=data['concurrency'],
+        __BENCHMARK_CONCURRENCY_LEVELS__=data['concurrency_levels'],
         __BENCHMARK_NETLATENCY__=data['netlatency'],
+        __BENCHMARK_NETWORK__=data['network'],
+        __BENCHMARK_RATE__=data['rate'],
+        __BENCHMARK_ARRIVAL__=data['arrival'],
+        __BENCHMARK_MIX__=data['mix'],
+        __BENCHMARK_KEYS__=data['keys'],
+        __BENCHMARK_WRITE_ISOLATION__=data['write_isolation'],
+        __BENCHMARK_RESET__=data['reset'],
         __BENCHMARK_IMPLEMENTATIONS__=data['implementations'],
         __BENCHMARK_DESCRIPTIONS__=data['benchmarks_desc'],
         __BENCHMARK_PLATFORM__=platform,
         __BENCHMARK_DATA__={
             b: json.dumps(v) for b, v in data['benchmarks'].items()
         },
+        __BENCHMARK_SWEEPS__={
+            b: json.dumps(v) for b, v in data['sweeps'].items()
+        },
+        __BENCHMARK_COMPARISON__=comparison,
     )
 
     output = tpl.render(**params)
@@ -249,6 +470,7 @@ def run_benchmarks(args, argv):
 
     try:
         agg_data = {}
+        sweeps = {}
         for cmd in lang_args.values():
             subprocess.run(
                 cmd, stdout=sys.stdout, stderr=sys.stderr, check=True)
@@ -264,12 +486,12 @@ def run_benchmarks(args, argv):
                     print(results, file=sys.stderr)
                     sys.exit(1)
 
-                process_results(raw_data, agg_data)
+                process_results(raw_data, agg_data, sweeps)
     finally:
         if os.path.exists('__tmp.json'):
             os.unlink('__tmp.json')
 
-    return mean_latency_stats(agg_data)
+    return mean_latency_stats(agg_data), sweeps
 
 
 def main():
@@ -319,18 +541,45 @@ def main():
         args.edgedb_port = int(instance_status["port"])
         argv.extend(("--edgedb-port", str(args.edgedb_port)))
 
-    benchmarks_data = run_benchmarks(args, argv)
+    benchmarks_data, sweeps = run_benchmarks(args, argv)
+
+    benchmarks_desc = dict(_utils.BENCHMARKS)
+    if args.mix:
+        benchmarks_desc[_utils.MIXED_WORKLOAD] = _utils.bench(
+            title='Mixed workload',
+            description='All queries of the mix combined: ' + ', '.join(
+                f'{q} ({w:g})' for q, w in args.mix.items()),
+        )
 
     date = datetime.datetime.now().strftime('%c')
     plat_info = platform_info()
     report_data = {
         'date': date,
         'duration': args.duration,
+        'warmup_time': args.warmup_time,
+        'adaptive_warmup': args.adaptive_warmup,
+        'repeat': args.repeat,
+        'target_ci': args.target_ci,
         'netlatency': args.net_latency,
+        'network': {
+            'proxied': args.net_proxy,
+            'latency': args.net_latency,
+            'jitter': args.net_jitter,
+            'distribution': args.net_delay_dist,
+            'bandwidth': args.net_bandwidth,
+        },
+        'rate': args.rate,
+        'arrival': args.arrival,
+        'mix': args.mix,
+        'keys': _keydist.describe(args),
+        'write_isolation': args.write_isolation,
+        'reset': args.reset,
         'platform': plat_info,
         'concurrency': args.concurrency,
+        'concurrency_levels': args.concurrency_levels,
         'benchmarks': benchmarks_data,
-        'benchmarks_desc': _utils.BENCHMARKS,
+        'sweeps': sweeps,
+        'benchmarks_desc': benchmarks_desc,
         'implementations': [
             _utils.IMPLEMENTATIONS[benchname].title
             for benchname in args.benchmarks
@@ -9,31 +9,58 @@
 
 
 import asyncio
+import collections
 import concurrent.futures as futures
+import itertools
 import json
 import math
 import multiprocessing
+import os
 import random
 import time
+import traceback
 import typing
 
-import numpy as np
 import uvloop
 
+import _histogram
+import _instrument
+import _keydist
+import _netproxy
+import _profiler
+import _resources
+import _stats
 import _utils
 
 
 class Result(typing.NamedTuple):
+    # All latencies are in nanoseconds.
 
     benchmark: str
     queryname: str
+    concurrency: int
     nqueries: int
     duration: int
     min_latency: int
-    avg_latency: int
+    avg_latency: float
     max_latency: int
-    latency_stats: typing.List[int]
+    latency_stats: _histogram.Histogram
+    timeseries: 'TimeSeries'
+    phases: typing.Dict[str, _histogram.Histogram]
     samples: typing.List[str]
+    nlate: int
+    trials: int
+    warmup: float
+    # Resources used by all client processes during the measurement
+    # (of all queries of a mixed workload).
+    resources: _resources.ResourceUsage
+    # The collapsed stacks of the workers during the measurement, with
+    # --profile, and the share of their CPU time taken by profiling.
+    profile: typing.Optional[str] = None
+    profile_overhead: typing.Optional[float] = None
+    # Activity of the database server during the measurement, for the
+    # implementations that can report it.
+    server: typing.Optional[dict] = None
 
 
 class LoopingValues:
@@ -50,161 +77,611 @@ class LoopingValues:
         return self.values[self.i]
 
 
-def run_benchmark_method(ctx, benchname, ids, queryname):
-    queries_mod = _utils.IMPLEMENTATIONS[benchname].module
-    if hasattr(queries_mod, 'init'):
-        queries_mod.init(ctx)
-
-    method = getattr(queries_mod, queryname)
-    conn = queries_mod.connect(ctx)
-    # This is used to loop over input IDs in such a way as to avoid
-    # repeating the same ID too closely to itself. This avoid
-    # conflicts when concurrently updating the same object.
-    id_loop = LoopingValues(ids)
+class ArrivalSchedule:
+    """Intended send times (in ns) of an open-loop request stream.
 
-    try:
-        samples = []
-        nqueries = 0
-        latency_stats = np.zeros((math.ceil(ctx.timeout) * 100 * 1000 + 1,))
-        min_latency = float('inf')
-        max_latency = 0.0
-
-        duration = ctx.warmup_time
-        start = time.monotonic()
-        while time.monotonic() - start < duration:
-            rid = id_loop.get_next()
-            method(conn, rid)
+    Latency is measured from the intended send time rather than from the
+    moment the request actually went out, so a stalled server is charged
+    for the requests it delayed (coordinated omission correction).
+    """
 
-        for _ in range(10):
-            rid = id_loop.get_next()
-            s = method(conn, rid)
-            if isinstance(s, bytes):
-                s = s.decode()
-            samples.append(s)
+    def __init__(self, rate, arrival, start):
+        self.rate = rate
+        self.arrival = arrival
+        self.interval = 1e9 / rate
+        # Stagger the streams of concurrent connections to avoid
+        # synchronized bursts at the start of every interval.
+        self.next_time = start + random.uniform(0, self.interval)
 
-        duration = ctx.duration
-        start = time.monotonic()
-        max_req_time = len(latency_stats) - 1
-        while time.monotonic() - start < duration:
-            rid = id_loop.get_next()
-            req_start = time.monotonic_ns()
-            method(conn, rid)
-            req_time = (time.monotonic_ns() - req_start) // 10000
-
-            if req_time > max_latency:
-                max_latency = req_time
-            if req_time < min_latency:
-                min_latency = req_time
+    def get_next(self):
+        t = self.next_time
+        if self.arrival == 'poisson':
+            self.next_time += random.expovariate(self.rate) * 1e9
+        else:
+            self.next_time += self.interval
+        return int(t)
+
+    def count_missed(self, end):
+        # Requests that were due before the end of the run, but were
+        # never sent because the connection was still busy.
+        missed = 0
+        while self.next_time < end:
+            self.get_next()
+            missed += 1
+        return missed
+
+
+def new_histogram(ctx):
+    return _histogram.Histogram(ctx.latency_digits, ctx.latency_resolution)
+
+
+class TimeSeries:
+    """Latency histograms of consecutive fixed-length measurement intervals.
+
+    Requests are attributed to the interval in which they completed.
+    """
+
+    def __init__(self, ctx, start):
+        self.start = start
+        self.interval = int(ctx.interval * 1e9)
+        self.histograms = [
+            new_histogram(ctx)
+            for _ in range(max(math.ceil(ctx.duration / ctx.interval), 1))
+        ]
+
+    def record(self, now, latency):
+        i = min((now - self.start) // self.interval, len(self.histograms) - 1)
+        self.histograms[i].record(latency)
+
+    def merge(self, other):
+        for hist, other_hist in zip(self.histograms, other.histograms):
+            hist.merge(other_hist)
+        return self
+
+    def extend(self, other):
+        # Append the intervals of a later measurement window.
+        self.histograms.extend(other.histograms)
+        return self
+
+
+class QueryStats:
+    """Measurements of one query collected by a single connection."""
+
+    def __init__(self, ctx, start):
+        self.ctx = ctx
+        self.latency_stats = new_histogram(ctx)
+        self.timeseries = TimeSeries(ctx, start)
+        # Latency histograms of the phases marked by the implementation.
+        self.phases = {}
+        self.samples = []
+        self.nlate = 0
+
+    def record(self, now, latency):
+        self.latency_stats.record(latency)
+        self.timeseries.record(now, latency)
+
+    def record_phases(self, phases, service_time):
+        if not phases:
+            return
+        for name, duration in phases.items():
+            self._phase(name).record(duration)
+        self._phase(_instrument.OTHER).record(
+            service_time - sum(phases.values()))
+
+    def _phase(self, name):
+        hist = self.phases.get(name)
+        if hist is None:
+            hist = self.phases[name] = new_histogram(self.ctx)
+        return hist
+
+    def _merge_phases(self, other):
+        for name, hist in other.phases.items():
+            self._phase(name).merge(hist)
+
+    def merge(self, other):
+        self.latency_stats.merge(other.latency_stats)
+        self.timeseries.merge(other.timeseries)
+        self._merge_phases(other)
+        self.samples.extend(other.samples)
+        self.nlate += other.nlate
+        return self
+
+    def extend(self, other):
+        # Add a later measurement window of the same connections, whose
+        # samples (taken during warmup) are already known.
+        self.latency_stats.merge(other.latency_stats)
+        self.timeseries.extend(other.timeseries)
+        self._merge_phases(other)
+        self.nlate += other.nlate
+        return self
+
+
+def make_key_chooser(ctx, values):
+    if ctx.key_dist == _keydist.SHUFFLE:
+        # This is used to loop over input IDs in such a way as to avoid
+        # repeating the same ID too closely to itself. This avoid
+        # conflicts when concurrently updating the same object.
+        return LoopingValues(values)
+    return _keydist.KeyChooser(
+        values, ctx.key_dist, zipf_s=ctx.zipf_s, hot_keys=ctx.hot_keys,
+        hot_traffic=ctx.hot_traffic)
+
+
+class QueryMix:
+    """Picks the next query to run by weight, along with its input ID."""
+
+    def __init__(self, ctx, ids, mix):
+        self.querynames = list(mix)
+        self.cum_weights = list(itertools.accumulate(mix.values()))
+        self.id_loops = {
+            queryname: make_key_chooser(ctx, ids[queryname])
+            for queryname in self.querynames
+        }
 
-            if req_time > max_req_time:
-                req_time = max_req_time
-            latency_stats[req_time] += 1
+    def get_next(self):
+        if len(self.querynames) == 1:
+            queryname = self.querynames[0]
+        else:
+            queryname = random.choices(
+                self.querynames, cum_weights=self.cum_weights)[0]
+        return queryname, self.id_loops[queryname].get_next()
 
-            nqueries += 1
 
-        return nqueries, latency_stats, min_latency, max_latency, samples
-    finally:
-        queries_mod.close(ctx, conn)
+def split_ids(ctx, ids, mix, nchunks, i):
+    if ctx.key_dist != _keydist.SHUFFLE:
+        # Skewed distributions are about the keys all clients share,
+        # contention included.
+        return ids
+    # We want to split the input ids into separate chunks, so that we
+    # avoid concurrent mutations of the same object.
+    chunk = {}
+    for queryname in mix:
+        method_ids = ids[queryname]
+        chunk_len = math.ceil(len(method_ids) / nchunks)
+        chunk[queryname] = method_ids[chunk_len*i:chunk_len*(i+1)]
+    return chunk
 
 
-async def run_async_benchmark_method(ctx, benchname, ids, queryname):
+def run_benchmark_method(ctx, benchname, ids, mix):
     queries_mod = _utils.IMPLEMENTATIONS[benchname].module
     if hasattr(queries_mod, 'init'):
         queries_mod.init(ctx)
 
-    method = getattr(queries_mod, queryname)
-    conn = await queries_mod.connect(ctx)
-    # This is used to loop over input IDs in such a way as to avoid
-    # repeating the same ID too closely to itself. This avoid
-    # conflicts when concurrently updating the same object.
-    id_loop = LoopingValues(ids)
+    methods = {
+        queryname: getattr(queries_mod, queryname) for queryname in mix
+    }
+    conn = queries_mod.connect(ctx)
+    query_mix = QueryMix(ctx, ids, mix)
 
     try:
-        samples = []
-        nqueries = 0
-        latency_stats = np.zeros((math.ceil(ctx.timeout) * 100 * 1000 + 1,))
-        min_latency = float('inf')
-        max_latency = 0.0
-
         duration = ctx.warmup_time
         start = time.monotonic()
         while time.monotonic() - start < duration:
-            rid = id_loop.get_next()
-            await method(conn, rid)
-
-        for _ in range(10):
-            rid = id_loop.get_next()
-            s = await method(conn, rid)
-            if isinstance(s, bytes):
-                s = s.decode()
-            samples.append(s)
+            queryname, rid = query_mix.get_next()
+            methods[queryname](conn, rid)
+
+        samples = {queryname: [] for queryname in mix}
+        for queryname, id_loop in query_mix.id_loops.items():
+            for _ in range(10):
+                rid = id_loop.get_next()
+                s = methods[queryname](conn, rid)
+                if isinstance(s, bytes):
+                    s = s.decode()
+                samples[queryname].append(s)
 
         duration = ctx.duration
+        _resources.reset_peak_rss()
+        usage = _resources.snapshot()
         start = time.monotonic()
-        max_req_time = len(latency_stats) - 1
+        stats = {
+            queryname: QueryStats(ctx, time.monotonic_ns())
+            for queryname in mix
+        }
+        schedule = None
+        if ctx.rate:
+            schedule = ArrivalSchedule(
+                ctx.rate / ctx.concurrency, ctx.arrival, time.monotonic_ns())
         while time.monotonic() - start < duration:
-            rid = id_loop.get_next()
-            req_start = time.monotonic_ns()
-            await method(conn, rid)
-            req_time = (time.monotonic_ns() - req_start) // 10000
+            queryname, rid = query_mix.get_next()
+            query_stats = stats[queryname]
+            if schedule is not None:
+                req_start = schedule.get_next()
+                lag = time.monotonic_ns() - req_start
+                if lag < 0:
+                    time.sleep(-lag / 1e9)
+                    # Timers may fire slightly early, never measure
+                    # from a point in the future.
+                    req_start = min(req_start, time.monotonic_ns())
+                elif lag > schedule.interval:
+                    query_stats.nlate += 1
+            else:
+                req_start = time.monotonic_ns()
+            methods[queryname](conn, rid)
+            req_end = time.monotonic_ns()
+            query_stats.record(req_end, req_end - req_start)
+
+        if schedule is not None:
+            for _ in range(schedule.count_missed((start + duration) * 1e9)):
+                stats[query_mix.get_next()[0]].nlate += 1
+
+        usage = _resources.since(usage)
+
+        for queryname, query_stats in stats.items():
+            query_stats.samples = samples[queryname]
+        return stats, usage
+    finally:
+        queries_mod.close(ctx, conn)
 
-            if req_time > max_latency:
-                max_latency = req_time
-            if req_time < min_latency:
-                min_latency = req_time
 
-            if req_time > max_req_time:
-                req_time = max_req_time
-            latency_stats[req_time] += 1
+async def warmup_connection(ctx, conn, methods, query_mix, duration,
+                            latency_stats):
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        queryname, rid = query_mix.get_next()
+        req_start = time.monotonic_ns()
+        await methods[queryname](conn, rid)
+        latency_stats.record(time.monotonic_ns() - req_start)
 
-            nqueries += 1
 
-        return nqueries, latency_stats, min_latency, max_latency, samples
-    finally:
-        await queries_mod.close(ctx, conn)
-
-
-def agg_results(results, benchname, queryname, duration) -> Result:
-    min_latency = float('inf')
-    max_latency = 0.0
-    nqueries = 0
-    latency_stats = None
-    samples = []
-    for result in results:
-        t_nqueries, t_lat_stats, t_min_latency, t_max_latency, t_samples = \
-            result
-        samples.append(random.choice(t_samples))
-        nqueries += t_nqueries
-        if latency_stats is None:
-            latency_stats = t_lat_stats
+async def sample_connection(ctx, conn, methods, query_mix):
+    samples = {queryname: [] for queryname in methods}
+    for queryname, id_loop in query_mix.id_loops.items():
+        for _ in range(10):
+            rid = id_loop.get_next()
+            s = await methods[queryname](conn, rid)
+            if isinstance(s, bytes):
+                s = s.decode()
+            samples[queryname].append(s)
+
+    return samples
+
+
+async def measure_connection(ctx, conn, methods, query_mix, concurrency):
+    duration = ctx.duration
+    start = time.monotonic()
+    stats = {
+        queryname: QueryStats(ctx, time.monotonic_ns())
+        for queryname in methods
+    }
+    schedule = None
+    if ctx.rate:
+        schedule = ArrivalSchedule(
+            ctx.rate / concurrency, ctx.arrival, time.monotonic_ns())
+    phases = _instrument.collect()
+    while time.monotonic() - start < duration:
+        queryname, rid = query_mix.get_next()
+        query_stats = stats[queryname]
+        if schedule is not None:
+            req_start = schedule.get_next()
+            lag = time.monotonic_ns() - req_start
+            if lag < 0:
+                await asyncio.sleep(-lag / 1e9)
+                # Timers may fire slightly early, never measure
+                # from a point in the future.
+                req_start = min(req_start, time.monotonic_ns())
+            elif lag > schedule.interval:
+                query_stats.nlate += 1
         else:
-            latency_stats = np.add(latency_stats, t_lat_stats)
-        if t_max_latency > max_latency:
-            max_latency = t_max_latency
-        if t_min_latency < min_latency:
-            min_latency = t_min_latency
+            req_start = time.monotonic_ns()
+        phases.clear()
+        sent = time.monotonic_ns()
+        await methods[queryname](conn, rid)
+        req_end = time.monotonic_ns()
+        query_stats.record(req_end, req_end - req_start)
+        query_stats.record_phases(phases, req_end - sent)
+
+    if schedule is not None:
+        for _ in range(schedule.count_missed((start + duration) * 1e9)):
+            stats[query_mix.get_next()[0]].nlate += 1
+
+    return stats
+
+
+class WorkerError(Exception):
+    pass
+
+
+class BenchWorker:
+    """State of a long-lived async benchmark worker process.
+
+    The worker keeps its event loop, the imported implementation module
+    and the open connections between the commands sent by the parent
+    (see WorkerPool).  Every public coroutine is a command.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.queries_mod = None
+        self.conns = []
+        self.methods = None
+        self.query_mixes = None
+        self.concurrency = None
+        self.samples = None
+        self.profiler = None
+
+    async def setup(self, benchname, nconns):
+        self.queries_mod = _utils.IMPLEMENTATIONS[benchname].module
+        if hasattr(self.queries_mod, 'init'):
+            self.queries_mod.init(self.ctx)
+        self.conns = await asyncio.gather(*(
+            self.queries_mod.connect(self.ctx) for _ in range(nconns)
+        ))
+
+    async def teardown(self):
+        conns, self.conns = self.conns, []
+        for conn in conns:
+            await self.queries_mod.close(self.ctx, conn)
+
+    async def load_ids(self):
+        conn = await self.queries_mod.connect(self.ctx)
+        try:
+            return await self.queries_mod.load_ids(self.ctx, conn)
+        finally:
+            await self.queries_mod.close(self.ctx, conn)
 
-    avg_latency = np.average(
-        np.arange(len(latency_stats)), weights=latency_stats)
+    async def cleanup(self, queryname):
+        if not hasattr(self.queries_mod, 'cleanup'):
+            return
+        conn = await self.queries_mod.connect(self.ctx)
+        try:
+            await self.queries_mod.cleanup(self.ctx, conn, queryname)
+        finally:
+            await self.queries_mod.close(self.ctx, conn)
+
+    async def restore_snapshot(self):
+        if not hasattr(self.queries_mod, 'restore_snapshot'):
+            return False
+        await self.queries_mod.restore_snapshot(self.ctx)
+        return True
+
+    async def server_stats(self, before=None):
+        # A snapshot of the statistics of the database server, or with
+        # *before*, the server activity since that snapshot.
+        if not hasattr(self.queries_mod, 'server_stats'):
+            return None
+        conn = await self.queries_mod.connect(self.ctx)
+        try:
+            snapshot = await self.queries_mod.server_stats(self.ctx, conn)
+        finally:
+            await self.queries_mod.close(self.ctx, conn)
+        if before is None:
+            return snapshot
+        return self.queries_mod.server_stats_delta(before, snapshot)
+
+    async def prepare(self, ids, mix, nconns, concurrency):
+        # Only the first *nconns* connections take part in the run,
+        # *concurrency* is the total across all workers.
+        self.methods = {
+            queryname: getattr(self.queries_mod, queryname)
+            for queryname in mix
+        }
+        self.query_mixes = [
+            QueryMix(self.ctx, split_ids(self.ctx, ids, mix, nconns, i), mix)
+            for i in range(nconns)
+        ]
+        self.concurrency = concurrency
+        if self.ctx.profile:
+            self.profiler = _profiler.Sampler(
+                self.ctx.profile_interval / 1000)
+
+    async def warmup(self, duration):
+        # Latencies of all connections, to detect the steady state.
+        latency_stats = new_histogram(self.ctx)
+        await asyncio.gather(*(
+            warmup_connection(
+                self.ctx, conn, self.methods, query_mix, duration,
+                latency_stats)
+            for conn, query_mix in zip(self.conns, self.query_mixes)
+        ))
+        return latency_stats
+
+    async def sample(self):
+        self.samples = await asyncio.gather(*(
+            sample_connection(self.ctx, conn, self.methods, query_mix)
+            for conn, query_mix in zip(self.conns, self.query_mixes)
+        ))
+
+    async def measure(self):
+        _resources.reset_peak_rss()
+        usage = _resources.snapshot()
+        if self.profiler is not None:
+            self.profiler.start()
+        try:
+            results = await asyncio.gather(*(
+                measure_connection(
+                    self.ctx, conn, self.methods, query_mix,
+                    self.concurrency)
+                for conn, query_mix in zip(self.conns, self.query_mixes)
+            ))
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+        usage = _resources.since(usage)
+        for stats, samples in zip(results, self.samples):
+            for queryname, query_stats in stats.items():
+                query_stats.samples = samples[queryname]
+        return results, usage
+
+    async def profile(self):
+        # Everything sampled during the measurements since prepare.
+        profiler = self.profiler
+        return (
+            profiler.stacks, profiler.cpu_time, profiler.process_cpu_time)
+
+
+def worker_main(ctx, pipe):
+    uvloop.install()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = BenchWorker(ctx)
 
+    try:
+        while True:
+            cmd, args = pipe.recv()
+            if cmd == 'stop':
+                break
+            try:
+                result = loop.run_until_complete(getattr(worker, cmd)(*args))
+            except Exception:
+                result = WorkerError(traceback.format_exc())
+            pipe.send(result)
+    finally:
+        if worker.conns:
+            loop.run_until_complete(worker.teardown())
+        loop.close()
+
+
+class WorkerPool:
+    """Async benchmark worker processes that live for the whole run.
+
+    Workers import the drivers, create their event loops and connect
+    once, instead of once per query, and are driven by the parent with
+    commands: setup, restore_snapshot, load_ids, server_stats, prepare,
+    warmup, sample, measure, profile, cleanup and teardown.
+    """
+
+    def __init__(self, ctx, nworkers):
+        self.pipes = []
+        self.procs = []
+        for _ in range(nworkers):
+            parent_end, child_end = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=worker_main, args=(ctx, child_end), daemon=True)
+            proc.start()
+            child_end.close()
+            self.pipes.append(parent_end)
+            self.procs.append(proc)
+
+    def __len__(self):
+        return len(self.procs)
+
+    def _recv(self, pipes):
+        # Every worker answers every command, so all the replies are read
+        # before raising, lest they be taken for replies to later ones.
+        results = [pipe.recv() for pipe in pipes]
+        for result in results:
+            if isinstance(result, WorkerError):
+                raise result
+        return results
+
+    def call(self, i, cmd, *args):
+        self.pipes[i].send((cmd, args))
+        return self._recv([self.pipes[i]])[0]
+
+    def broadcast(self, cmd, *args):
+        return self.map(cmd, [args] * len(self))
+
+    def map(self, cmd, args_list):
+        for pipe, args in zip(self.pipes, args_list):
+            pipe.send((cmd, args))
+        return self._recv(self.pipes)
+
+    def close(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send(('stop', ()))
+            except OSError:
+                pass
+        for proc in self.procs:
+            proc.join(timeout=30)
+            if proc.is_alive():
+                proc.terminate()
+
+
+def make_result(benchname, queryname, concurrency, duration, trials,
+                warmup, usage, stats) -> Result:
     return Result(
         benchmark=benchname,
         queryname=queryname,
-        nqueries=nqueries,
+        concurrency=concurrency,
+        nqueries=stats.latency_stats.total,
         duration=duration,
-        min_latency=min_latency,
-        avg_latency=avg_latency,
-        max_latency=max_latency,
-        latency_stats=latency_stats,
-        samples=samples,
+        min_latency=stats.latency_stats.min or 0,
+        avg_latency=stats.latency_stats.mean(),
+        max_latency=stats.latency_stats.max or 0,
+        latency_stats=stats.latency_stats,
+        timeseries=stats.timeseries,
+        phases=stats.phases,
+        samples=stats.samples,
+        nlate=stats.nlate,
+        trials=trials,
+        warmup=warmup,
+        resources=usage,
     )
 
 
-def run_benchmark_sync(ctx, benchname, ids, queryname) -> Result:
-    method_ids = ids[queryname]
-    # We want to split the input ids into separate chunks, so that we
-    # avoid concurrent mutations of the same object.
-    chunk_len = math.ceil(len(method_ids) / ctx.concurrency)
+def agg_results(ctx, trials, benchname, mix, concurrency, warmup,
+                usages) -> typing.List[Result]:
+    # *trials* are consecutive measurements of the same workload, each
+    # a list of the per-connection results, and *usages* the resources
+    # used by every client process in each of them.
+    usage = _resources.total(
+        (_resources.total(u, concurrent=True) for u in usages),
+        concurrent=False)
+
+    merged = None
+    for results in trials:
+        trial = {queryname: QueryStats(ctx, 0) for queryname in mix}
+        for result in results:
+            for queryname, stats in result.items():
+                # Keep one sample per connection.
+                stats.samples = [random.choice(stats.samples)]
+                trial[queryname].merge(stats)
+
+        if merged is None:
+            merged = trial
+        else:
+            for queryname, stats in trial.items():
+                merged[queryname].extend(stats)
+
+    duration = ctx.duration * len(trials)
+    # The queries of a mixed workload share the client processes, whose
+    # resources are split by the number of queries.
+    nqueries = sum(stats.latency_stats.total for stats in merged.values())
+    agg = [
+        make_result(
+            benchname, queryname, concurrency, duration, len(trials), warmup,
+            _resources.share(
+                usage, merged[queryname].latency_stats.total / nqueries
+                if nqueries else 0),
+            merged[queryname])
+        for queryname in mix
+    ]
+
+    if len(mix) > 1:
+        # The aggregate over all queries of a mixed workload.
+        total = QueryStats(ctx, 0)
+        for _ in trials[1:]:
+            total.timeseries.extend(TimeSeries(ctx, 0))
+        for stats in merged.values():
+            total.merge(stats)
+        agg.append(make_result(
+            benchname, _utils.MIXED_WORKLOAD, concurrency, duration,
+            len(trials), warmup, usage, total))
+
+    return agg
+
+
+def is_converged(ctx, result: Result):
+    """Tell if the confidence intervals of a result are narrow enough."""
+    if not ctx.target_ci or result.duration >= ctx.max_duration:
+        return True
+
+    qps_ci, percentile_cis = _stats.bootstrap_ci(
+        result.timeseries.histograms, ctx.interval, [99])
+    if qps_ci is None:
+        return False
+
+    qps_width = _stats.relative_ci_width(
+        qps_ci, result.nqueries / result.duration)
+    p99_width = _stats.relative_ci_width(
+        percentile_cis[0], result.latency_stats.value_at_percentile(99))
+    print(f'ci width:\t{qps_width * 100:.1f}% (qps), '
+          f'{p99_width * 100:.1f}% (p99) after {result.duration}s')
+    return max(qps_width, p99_width) <= ctx.target_ci
+
+
+def run_benchmark_sync(ctx, benchname, ids, mix) -> typing.List[Result]:
     with futures.ProcessPoolExecutor(max_workers=ctx.concurrency) as e:
         tasks = []
         for i in range(ctx.concurrency):
@@ -212,61 +689,22 @@ def run_benchmark_sync(ctx, benchname, ids, queryname) -> Result:
                 run_benchmark_method,
                 ctx,
                 benchname,
-                method_ids[chunk_len*i:chunk_len*(i+1)],
-                queryname)
+                split_ids(ctx, ids, mix, ctx.concurrency, i),
+                mix)
             tasks.append(task)
 
         results = [fut.result() for fut in futures.wait(tasks).done]
 
-    return agg_results(results, benchname, queryname, ctx.duration)
-
-
-def do_run_benchmark_async(ctx, benchname, ids, iproc, queryname) -> Result:
-    method_ids = ids[queryname]
-    # We want to split the input ids into separate chunks, so that we
-    # avoid concurrent mutations of the same object.
-    proc_chunk_len = math.ceil(len(method_ids) / ctx.async_split)
-    method_ids = method_ids[proc_chunk_len*iproc:proc_chunk_len*(iproc+1)]
-    chunk_len = math.ceil(
-        len(method_ids) / (ctx.concurrency // ctx.async_split)
-    )
-
-    uvloop.install()
-
-    async def run():
-        tasks = []
-        for i in range(ctx.concurrency // ctx.async_split):
-            task = asyncio.create_task(
-                run_async_benchmark_method(
-                    ctx,
-                    benchname,
-                    method_ids[chunk_len*i:chunk_len*(i+1)],
-                    queryname))
-            tasks.append(task)
-
-        return await asyncio.gather(*tasks)
-
-    return asyncio.run(run())
-
-
-def run_benchmark_async(ctx, benchname, ids, queryname) -> Result:
-    # We want to split the input ids into separate chunks, so that we
-    # avoid concurrent mutations of the same object.
-    with futures.ProcessPoolExecutor(max_workers=ctx.async_split) as e:
-        tasks = []
-        for i in range(ctx.async_split):
-            task = e.submit(
-                do_run_benchmark_async,
-                ctx,
-                benchname,
-                ids,
-                i,
-                queryname)
-            tasks.append(task)
+    return agg_results(
+        ctx, [[stats for stats, _ in results]], benchname, mix,
+        ctx.concurrency, ctx.warmup_time, [[usage for _, usage in results]])
 
-        results = [r for fut in futures.wait(tasks).done for r in fut.result()]
 
-    return agg_results(results, benchname, queryname, ctx.duration)
+def workloads(ctx):
+    if ctx.mix:
+        return [ctx.mix]
+    else:
+        return [{queryname: 1} for queryname in ctx.queries]
 
 
 def run_sync(ctx, benchname) -> typing.List[Result]:
@@ -279,76 +717,291 @@ def run_sync(ctx, benchname) -> typing.List[Result]:
     ids = queries_mod.load_ids(ctx, idconn)
     queries_mod.close(ctx, idconn)
 
-    for queryname in ctx.queries:
-        conn = queries_mod.connect(ctx)
-
-        res = run_benchmark_sync(ctx, benchname, ids, queryname)
-        results.append(res)
-        print_result(ctx, res)
-        queries_mod.close(ctx, conn)
+    for mix in workloads(ctx):
+        res = run_benchmark_sync(ctx, benchname, ids, mix)
+        results.extend(res)
+        for r in res:
+            print_result(ctx, r)
 
         # Potentially clean up after the benchmarks
-        conn = queries_mod.connect(ctx)
-        queries_mod.cleanup(ctx, conn, queryname)
-        queries_mod.close(ctx, conn)
+        for queryname in mix:
+            conn = queries_mod.connect(ctx)
+            queries_mod.cleanup(ctx, conn, queryname)
+            queries_mod.close(ctx, conn)
 
     return results
 
 
-def run_async(ctx, benchname) -> typing.List[Result]:
-    queries_mod = _utils.IMPLEMENTATIONS[benchname].module
-    results = []
+def conns_per_worker(concurrency, nworkers):
+    return [
+        concurrency // nworkers + (i < concurrency % nworkers)
+        for i in range(nworkers)
+    ]
+
+
+def run_warmup(ctx, pool):
+    """Warm up the connections of all workers, and take samples.
+
+    With --adaptive-warmup, the workers run in windows of
+    --warmup-window seconds until the throughput and the mean latency
+    of the last --warmup-windows windows agree within
+    --warmup-tolerance, for at most --warmup-time seconds.  The parent
+    decides, so that all workers switch to measuring together.
+    Returns the length of the warmup in seconds.
+    """
+    if not ctx.adaptive_warmup:
+        pool.broadcast('warmup', ctx.warmup_time)
+        pool.broadcast('sample')
+        return ctx.warmup_time
+
+    windows = []
+    elapsed = 0
+    while elapsed < ctx.warmup_time:
+        window = min(ctx.warmup_window, ctx.warmup_time - elapsed)
+        latency_stats = new_histogram(ctx)
+        for stats in pool.broadcast('warmup', window):
+            latency_stats.merge(stats)
+        elapsed += window
+        windows.append((latency_stats.total / window, latency_stats.mean()))
+        if _stats.is_steady(windows, ctx.warmup_windows, ctx.warmup_tolerance):
+            break
+    else:
+        print(f'warmup:\t\tno steady state after {elapsed:g}s')
 
-    async def fetch_ids():
-        if hasattr(queries_mod, 'init'):
-            queries_mod.init(ctx)
-        conn = await queries_mod.connect(ctx)
-        try:
-            return await queries_mod.load_ids(ctx, conn)
-        finally:
-            await queries_mod.close(ctx, conn)
+    pool.broadcast('sample')
+    return elapsed
 
-    async def cleanup():
-        if not hasattr(queries_mod, 'cleanup'):
-            return
-        conn = await queries_mod.connect(ctx)
-        try:
-            return await queries_mod.cleanup(ctx, conn, queryname)
-        finally:
-            await queries_mod.close(ctx, conn)
 
-    uvloop.install()
-    ids = asyncio.run(fetch_ids())
+def write_profile(ctx, pool, benchname, mix, concurrency):
+    """Merge the profiles of all workers into a collapsed stacks file.
 
-    for queryname in ctx.queries:
-        res = run_benchmark_async(ctx, benchname, ids, queryname)
-        results.append(res)
-        print_result(ctx, res)
+    Returns the name of the file and the profiling overhead.
+    """
+    stacks = collections.Counter()
+    cpu_time = process_cpu_time = 0.0
+    for worker_stacks, worker_cpu, worker_process_cpu in pool.broadcast(
+            'profile'):
+        stacks.update(worker_stacks)
+        cpu_time += worker_cpu
+        process_cpu_time += worker_process_cpu
+
+    workload = next(iter(mix)) if len(mix) == 1 else _utils.MIXED_WORKLOAD
+    name = f'{benchname}-{workload}'
+    if len(ctx.concurrency_levels) > 1:
+        name += f'-{concurrency}'
+    filename = os.path.abspath(
+        os.path.join(ctx.profile, f'{name}.collapsed'))
+    os.makedirs(ctx.profile, exist_ok=True)
+    _profiler.write_collapsed(stacks, filename)
+
+    overhead = cpu_time / process_cpu_time if process_cpu_time else 0.0
+    return filename, overhead
 
-        # Potentially clean up after the benchmarks
-        asyncio.run(cleanup())
+
+def reset_dataset(ctx, pool, benchname):
+    # Open connections would keep the database busy.
+    pool.broadcast('teardown')
+    try:
+        return pool.call(0, 'restore_snapshot')
+    finally:
+        pool.broadcast(
+            'setup', benchname, math.ceil(ctx.concurrency / len(pool)))
+
+
+def run_async(ctx, pool, benchname) -> typing.List[Result]:
+    results = []
+
+    pool.broadcast(
+        'setup', benchname, math.ceil(ctx.concurrency / len(pool)))
+    try:
+        # Without a snapshot, the implementation cleans up after itself.
+        reset = ctx.reset and reset_dataset(ctx, pool, benchname)
+        ids = pool.call(0, 'load_ids')
+
+        for mix in workloads(ctx):
+            points = []
+            for concurrency in ctx.concurrency_levels:
+                nconns = conns_per_worker(concurrency, len(pool))
+                pool.map('prepare', [
+                    (split_ids(ctx, ids, mix, len(pool), i), mix, nconns[i],
+                     concurrency)
+                    for i in range(len(pool))
+                ])
+                warmup_time = run_warmup(ctx, pool)
+                server_stats = pool.call(0, 'server_stats')
+                trials = []
+                usages = []
+                while True:
+                    measured = pool.broadcast('measure')
+                    trials.append([r for rs, _ in measured for r in rs])
+                    usages.append([usage for _, usage in measured])
+                    res = agg_results(
+                        ctx, trials, benchname, mix, concurrency,
+                        warmup_time, usages)
+                    if len(trials) >= ctx.repeat and is_converged(
+                            ctx, res[-1]):
+                        break
+                if server_stats is not None:
+                    # The server sees the whole workload, not its queries.
+                    server = pool.call(0, 'server_stats', server_stats)
+                    res[-1] = res[-1]._replace(server=server)
+                if ctx.profile:
+                    profile, overhead = write_profile(
+                        ctx, pool, benchname, mix, concurrency)
+                    res = [
+                        r._replace(profile=profile, profile_overhead=overhead)
+                        for r in res
+                    ]
+                results.extend(res)
+                for r in res:
+                    print_result(ctx, r)
+
+                # Potentially clean up after the benchmarks
+                if reset and any(
+                        _utils.BENCHMARKS[q].writes for q in mix):
+                    reset_dataset(ctx, pool, benchname)
+                else:
+                    for queryname in mix:
+                        if ctx.write_isolation == 'bulk-delete':
+                            # Every worker knows the rows it inserted.
+                            pool.broadcast('cleanup', queryname)
+                        else:
+                            pool.call(0, 'cleanup', queryname)
+
+                if ctx.stop_at_knee:
+                    total = res[-1]
+                    points.append((
+                        total.nqueries / total.duration,
+                        total.latency_stats.value_at_percentile(99),
+                    ))
+                    knee = _stats.find_knee(points, ctx.knee_threshold)
+                    if knee is not None:
+                        print(f'knee:\t\t{ctx.concurrency_levels[knee]} '
+                              f'connections')
+                        print()
+                        break
+    finally:
+        pool.broadcast('teardown')
 
     return results
 
 
-def run_bench(ctx, benchname) -> typing.List[Result]:
-    queries_mod = _utils.IMPLEMENTATIONS[benchname].module
+def measure_startup(ctx, benchname, spawned_at):
+    started_at = time.monotonic()
+
+    impl = _utils.IMPLEMENTATIONS[benchname]
+    queries_mod = impl.module
+    imported_at = time.monotonic()
+
+    if hasattr(queries_mod, 'init'):
+        queries_mod.init(ctx)
+
     if getattr(queries_mod, 'ASYNC', False):
-        return run_async(ctx, benchname)
+        async def connect():
+            conn = await queries_mod.connect(ctx)
+            connected_at = time.monotonic()
+            await queries_mod.close(ctx, conn)
+            return connected_at
+
+        uvloop.install()
+        connect_start = time.monotonic()
+        connected_at = asyncio.run(connect())
     else:
-        return run_sync(ctx, benchname)
+        connect_start = time.monotonic()
+        conn = queries_mod.connect(ctx)
+        connected_at = time.monotonic()
+        queries_mod.close(ctx, conn)
+
+    return {
+        'spawn': started_at - spawned_at,
+        'import': imported_at - started_at,
+        'connect': connected_at - connect_start,
+    }
+
+
+def run_measure_startup(ctx, benchname):
+    # Every adapter is measured in a fresh process, so that nothing is
+    # imported yet.
+    with futures.ProcessPoolExecutor(max_workers=1) as e:
+        startup = e.submit(
+            measure_startup, ctx, benchname, time.monotonic()).result()
+
+    print(f'== {benchname} : startup ==')
+    print(f'spawn:\t\t{startup["spawn"] * 1000:.2f}ms')
+    print(f'import:\t\t{startup["import"] * 1000:.2f}ms')
+    print(f'connect:\t{startup["connect"] * 1000:.2f}ms')
+    print()
+
+    return startup
 
 
 def print_result(ctx, result: Result):
-    print(f'== {result.benchmark} : {result.queryname} ==')
+    if len(ctx.concurrency_levels) > 1:
+        print(f'== {result.benchmark} : {result.queryname} '
+              f'({result.concurrency} connections) ==')
+    else:
+        print(f'== {result.benchmark} : {result.queryname} ==')
     print(f'queries:\t{result.nqueries}')
-    print(f'qps:\t\t{result.nqueries // ctx.duration} q/s')
-    print(f'min latency:\t{result.min_latency / 100:.2f}ms')
-    print(f'avg latency:\t{result.avg_latency / 100:.2f}ms')
-    print(f'max latency:\t{result.max_latency / 100:.2f}ms')
+    print(f'qps:\t\t{result.nqueries // result.duration} q/s')
+    print(f'min latency:\t{result.min_latency / 1e6:.2f}ms')
+    print(f'avg latency:\t{result.avg_latency / 1e6:.2f}ms')
+    print(f'max latency:\t{result.max_latency / 1e6:.2f}ms')
+    if ctx.rate:
+        print(f'late requests:\t{result.nlate}')
+    if result.trials > 1:
+        print(f'trials:\t\t{result.trials}')
+    if ctx.adaptive_warmup:
+        print(f'warmup:\t\t{result.warmup:g}s')
+    if result.phases:
+        phases = ', '.join(
+            f'{name} {hist.mean() / 1e6:.2f}ms'
+            for name, hist in result.phases.items()
+        )
+        print(f'phases (avg):\t{phases}')
+    usage = result.resources
+    print(f'client cpu:\t'
+          f'{usage.cpu_time / max(result.nqueries, 1) * 1e6:.1f}us/q '
+          f'({usage.cpu_time / result.duration * 100:.0f}% of a core), '
+          f'peak rss {usage.peak_rss / 2 ** 20:.1f}MiB')
+    if result.server and result.server['statements']:
+        statements = result.server['statements']
+        print(f'server time:\t'
+              f'{statements["exec_time"] / max(result.nqueries, 1):.3f}ms/q '
+              f'in {statements["calls"]} statement calls')
+    if result.profile:
+        print(f'profile:\t{result.profile} '
+              f'({result.profile_overhead * 100:.1f}% overhead)')
     print()
 
 
+def start_net_proxy(ctx):
+    """Route the connections to the databases through a proxy injecting
+    the network conditions, by pointing the ports of *ctx* to it."""
+    targets = {'postgres': (ctx.db_host, ctx.pg_port)}
+    if 'edgedb_py_async' in ctx.benchmarks:
+        # Without --edgedb-port, to the instance of the project.
+        edgedb = _utils.IMPLEMENTATIONS['edgedb_py_async'].module
+        targets['edgedb'] = edgedb.net_target(ctx)
+    elif ctx.edgedb_port:
+        targets['edgedb'] = (ctx.db_host, ctx.edgedb_port)
+
+    proxy = _netproxy.NetProxy(
+        _netproxy.NetConfig(
+            latency=ctx.net_latency,
+            jitter=ctx.net_jitter,
+            distribution=ctx.net_delay_dist,
+            bandwidth=ctx.net_bandwidth,
+        ),
+        targets)
+    ports = proxy.start()
+
+    ctx.db_host = '127.0.0.1'
+    ctx.pg_port = ports['postgres']
+    if 'edgedb' in ports:
+        ctx.edgedb_port = ports['edgedb']
+    return proxy
+
+
 def main():
     multiprocessing.set_start_method('spawn')
 
@@ -357,21 +1010,72 @@ def main():
         out_to_json=True)
 
     print('============ Python ============')
-    print(f'concurrency:\t{ctx.concurrency}')
-    print(f'warmup time:\t{ctx.warmup_time} seconds')
+    if len(ctx.concurrency_levels) > 1:
+        levels = ', '.join(str(c) for c in ctx.concurrency_levels)
+        if ctx.stop_at_knee:
+            levels += ' (until the knee)'
+        print(f'concurrency:\t{levels}')
+    else:
+        print(f'concurrency:\t{ctx.concurrency}')
+    if ctx.rate:
+        print(f'target rate:\t{ctx.rate} q/s ({ctx.arrival} arrivals)')
+    if ctx.adaptive_warmup:
+        print(f'warmup time:\tuntil steady, at most {ctx.warmup_time} '
+              f'seconds')
+    else:
+        print(f'warmup time:\t{ctx.warmup_time} seconds')
     print(f'duration:\t{ctx.duration} seconds')
-    print(f'queries:\t{", ".join(q for q in ctx.queries)}')
+    if ctx.mix:
+        mix = ', '.join(f'{q}={w:g}' for q, w in ctx.mix.items())
+        print(f'mix:\t\t{mix}')
+    else:
+        print(f'queries:\t{", ".join(q for q in ctx.queries)}')
     print(f'benchmarks:\t{", ".join(b for b in ctx.benchmarks)}')
+    if ctx.write_isolation != 'none':
+        print(f'writes:\t\t{ctx.write_isolation} isolation')
+    if ctx.reset:
+        print('reset:\t\tbefore the benchmarks and after writes')
+    if ctx.key_dist != _keydist.SHUFFLE:
+        keys = ', '.join(
+            f'{k}={v}' for k, v in _keydist.describe(ctx).items())
+        print(f'keys:\t\t{keys}')
+    if ctx.net_proxy:
+        net = f'{ctx.net_latency}ms round trip'
+        if ctx.net_jitter:
+            net += f', {ctx.net_jitter}ms {ctx.net_delay_dist} jitter'
+        if ctx.net_bandwidth:
+            net += f', {ctx.net_bandwidth} Mbit/s'
+        print(f'network:\t{net}')
     print()
 
     data = []
-    for benchmark in ctx.benchmarks:
-        bench_desc = _utils.IMPLEMENTATIONS[benchmark]
-        if bench_desc.language != 'python':
-            continue
-
-        res = run_bench(ctx, benchmark)
-        data.append(res)
+    startup = {}
+    pool = None
+    proxy = None
+    try:
+        if ctx.net_proxy:
+            proxy = start_net_proxy(ctx)
+
+        for benchmark in ctx.benchmarks:
+            bench_desc = _utils.IMPLEMENTATIONS[benchmark]
+            if bench_desc.language != 'python':
+                continue
+
+            if ctx.measure_startup:
+                startup[benchmark] = run_measure_startup(ctx, benchmark)
+
+            if getattr(bench_desc.module, 'ASYNC', False):
+                if pool is None:
+                    pool = WorkerPool(ctx, ctx.async_split)
+                res = run_async(ctx, pool, benchmark)
+            else:
+                res = run_sync(ctx, benchmark)
+            data.append(res)
+    finally:
+        if pool is not None:
+            pool.close()
+        if proxy is not None:
+            proxy.close()
 
     if ctx.json:
         json_data = []
@@ -380,12 +1084,26 @@ def main():
             for r in results:
                 json_results.append({
                     'queryname': r.queryname,
+                    'concurrency': r.concurrency,
+                    'duration': r.duration,
+                    'trials': r.trials,
+                    'warmup': r.warmup,
+                    'resources': r.resources._asdict(),
+                    'server': r.server,
+                    'profile': r.profile,
+                    'profile_overhead': r.profile_overhead,
                     'nqueries': r.nqueries,
                     'min_latency': r.min_latency,
                     'max_latency': r.max_latency,
-                    'latency_stats':
-                        [int(i) for i in r.latency_stats.tolist()],
+                    'latency_stats': r.latency_stats.to_dict(),
+                    'timeseries': [
+                        h.to_dict() for h in r.timeseries.histograms
+                    ],
+                    'phases': {
+                        name: h.to_dict() for name, h in r.phases.items()
+                    },
                     'samples': r.samples,
+                    'nlate': r.nlate,
                 })
             json_data.append({
                 'benchmark': results[0].benchmark,
@@ -396,8 +1114,23 @@ def main():
         data = json.dumps({
             'language': 'python',
             'concurrency': ctx.concurrency,
+            'knee_threshold': ctx.knee_threshold,
+            'rate': ctx.rate,
+            'arrival': ctx.arrival,
             'warmup_time': ctx.warmup_time,
+            'adaptive_warmup': ctx.adaptive_warmup,
             'duration': ctx.duration,
+            'repeat': ctx.repeat,
+            'target_ci': ctx.target_ci,
+            'max_duration': ctx.max_duration,
+            'interval': ctx.interval,
+            'net_proxy': ctx.net_proxy,
+            'mix': ctx.mix,
+            'keys': _keydist.describe(ctx),
+            'seed': ctx.seed,
+            'write_isolation': ctx.write_isolation,
+            'reset': ctx.reset,
+            'startup': startup,
             'data': json_data,
         })
         with open(ctx.json, 'wt') as f:
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (c) 2019 MagicStack Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import statistics
+import sys
+
+import bench
+import _stats
+
+
+BASELINE_DIR = pathlib.Path(__file__).parent / 'baselines'
+
+# Metrics compared between runs: name, title and whether higher is better.
+METRICS = [
+    ('qps', 'qps', True),
+    ('p50', 'p50 (ms)', False),
+    ('p99', 'p99 (ms)', False),
+]
+
+# Runs with fewer per-interval values (reports of older versions have
+# none) cannot be tested for a significant change.
+MIN_INTERVALS = 5
+
+
+class Run:
+    """Per-interval measurements of one query, implementation and
+    concurrency, collected from one or more result files."""
+
+    def __init__(self):
+        self.estimates = {metric: [] for metric, _, _ in METRICS}
+        self.intervals = {metric: [] for metric, _, _ in METRICS}
+
+    def add(self, point):
+        for metric, _, _ in METRICS:
+            self.estimates[metric].append(point[metric])
+            if point.get('timeseries'):
+                self.intervals[metric].extend(point['timeseries'][metric])
+
+    def estimate(self, metric):
+        return statistics.mean(self.estimates[metric])
+
+
+def load_runs(filenames):
+    """Load ``bench.py --json`` reports into a dict of runs keyed by
+    ``(query, implementation, concurrency)``."""
+    runs = {}
+    for filename in filenames:
+        with open(filename, 'rt') as f:
+            report = json.load(f)
+
+        points = {}
+        for query, entries in report['benchmarks'].items():
+            if query == 'mean':
+                continue
+            for entry in entries:
+                concurrency = entry.get('concurrency', report['concurrency'])
+                points[query, entry['implementation'], concurrency] = dict(
+                    qps=entry['qps'],
+                    p50=bench._percentile(entry, 50),
+                    p99=bench._percentile(entry, 99),
+                    timeseries=entry.get('timeseries'),
+                )
+        # Every level of a concurrency sweep, not only the charted one.
+        for query, sweeps in report.get('sweeps', {}).items():
+            for sweep in sweeps:
+                for point in sweep['points']:
+                    points[query, sweep['implementation'],
+                           point['concurrency']] = point
+
+        for key, point in points.items():
+            runs.setdefault(key, Run()).add(point)
+
+    return runs
+
+
+def baseline_files(name, baseline_dir):
+    path = pathlib.Path(baseline_dir) / name
+    files = sorted(path.glob('*.json'))
+    if not files:
+        raise FileNotFoundError(f'baseline {name!r} not found in {path}')
+    return files
+
+
+def save_baseline(name, filenames, baseline_dir):
+    path = pathlib.Path(baseline_dir) / name
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+    for i, filename in enumerate(filenames):
+        target = path / f'{i:03d}-{os.path.basename(filename)}'
+        shutil.copyfile(filename, target)
+
+
+def compare_runs(baseline, current, *, threshold, alpha):
+    """Compare two sets of runs.
+
+    A metric regressed when it changed for the worse by more than
+    *threshold* (relative), and the Mann-Whitney U test of the
+    per-interval values of both runs is significant at *alpha*.  With
+    fewer than MIN_INTERVALS of them in either run, the metric has
+    insufficient data and is not tested.
+    """
+    rows = []
+    for key in sorted(baseline.keys() & current.keys()):
+        query, implementation, concurrency = key
+        row = dict(
+            query=query,
+            implementation=implementation,
+            concurrency=concurrency,
+            metrics=[],
+            regression=False,
+            insufficient=False,
+        )
+        for metric, title, higher_is_better in METRICS:
+            base = baseline[key].estimate(metric)
+            cur = current[key].estimate(metric)
+            change = (cur - base) / base if base else 0.0
+            x = baseline[key].intervals[metric]
+            y = current[key].intervals[metric]
+            insufficient = min(len(x), len(y)) < MIN_INTERVALS
+            if insufficient:
+                pvalue = None
+            else:
+                _, pvalue = _stats.mann_whitney_u(x, y)
+            significant = pvalue is not None and pvalue < alpha
+            worse = -change if higher_is_better else change
+            regression = worse > threshold and significant
+            row['metrics'].append(dict(
+                metric=metric,
+                title=title,
+                baseline=base,
+                current=cur,
+                change=round(change * 100, 2),
+                pvalue=pvalue,
+                significant=significant,
+                regression=regression,
+                insufficient=insufficient,
+            ))
+            row['regression'] = row['regression'] or regression
+            row['insufficient'] = row['insufficient'] or insufficient
+        rows.append(row)
+
+    missing = sorted(baseline.keys() ^ current.keys())
+    return rows, missing
+
+
+def format_rows(rows):
+    header = ['query', 'implementation', 'conc']
+    for _, title, _ in METRICS:
+        header.extend([title, 'change', 'p-value'])
+    header.append('')
+
+    lines = [header]
+    for row in rows:
+        line = [
+            row['query'], row['implementation'], str(row['concurrency'])
+        ]
+        for m in row['metrics']:
+            line.extend([
+                f"{m['baseline']:g} -> {m['current']:g}",
+                f"{m['change']:+.1f}%",
+                'n/a' if m['insufficient'] else
+                f"{m['pvalue']:.3f}" + ('*' if m['significant'] else ''),
+            ])
+        if row['regression']:
+            line.append('REGRESSION')
+        elif row['insufficient']:
+            line.append('INSUFFICIENT DATA')
+        else:
+            line.append('')
+        lines.append(line)
+
+    widths = [max(len(line[i]) for line in lines)
+              for i in range(len(header))]
+    table = '\n'.join(
+        '  '.join(cell.ljust(width) for cell, width in zip(line, widths))
+        .rstrip()
+        for line in lines
+    )
+    if any(row['insufficient'] for row in rows):
+        table += (
+            f'\nINSUFFICIENT DATA: fewer than {MIN_INTERVALS} per-interval '
+            f'values in a run, the changes marked n/a were not tested')
+    return table
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare benchmark results with a baseline',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'results',
+        nargs='+',
+        help='JSON reports written by bench.py --json; unless --baseline '
+        'is given, the first one is the baseline of the others',
+    )
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default=None,
+        help='name of a saved baseline to compare all results with',
+    )
+    parser.add_argument(
+        '--save-baseline',
+        type=str,
+        default=None,
+        help='save the results as the baseline of this name',
+    )
+    parser.add_argument(
+        '--baseline-dir',
+        type=str,
+        default=str(BASELINE_DIR),
+        help='directory with saved baselines',
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.05,
+        help='relative change for the worse that counts as a regression',
+    )
+    parser.add_argument(
+        '--alpha',
+        type=float,
+        default=0.05,
+        help='significance level of the Mann-Whitney U test',
+    )
+    parser.add_argument(
+        '--json', type=str, default='',
+        help='filename to dump the comparison in JSON')
+    parser.add_argument(
+        '--html', type=str, default='',
+        help='filename to dump the HTML report of the last result, '
+        'including the comparison')
+
+    args = parser.parse_args()
+
+    if (not args.baseline and not args.save_baseline
+            and len(args.results) < 2):
+        parser.error('at least two result files or --baseline are required')
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.baseline:
+        baseline_name = args.baseline
+        baseline = load_runs(baseline_files(args.baseline, args.baseline_dir))
+        candidates = args.results
+    else:
+        baseline_name = args.results[0]
+        baseline = load_runs(args.results[:1])
+        candidates = args.results[1:]
+
+    comparisons = []
+    regressed = False
+    for candidate in candidates:
+        rows, missing = compare_runs(
+            baseline, load_runs([candidate]),
+            threshold=args.threshold, alpha=args.alpha)
+        regressed = regressed or any(row['regression'] for row in rows)
+        comparisons.append(dict(
+            baseline=baseline_name,
+            candidate=candidate,
+            rows=rows,
+            missing=[list(key) for key in missing],
+        ))
+
+        print(f'== {candidate} vs. {baseline_name} ==')
+        print(format_rows(rows))
+        for key in missing:
+            print('not in both runs: {} / {} / {}'.format(*key))
+        print()
+
+    if args.json:
+        with open(args.json, 'wt') as f:
+            json.dump(dict(
+                threshold=args.threshold,
+                alpha=args.alpha,
+                comparisons=comparisons,
+            ), f)
+
+    if args.html and comparisons:
+        with open(comparisons[-1]['candidate'], 'rt') as f:
+            report = json.load(f)
+        bench.format_report_html(report, args.html, dict(
+            threshold=args.threshold,
+            alpha=args.alpha,
+            comparisons=comparisons,
+        ))
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, args.results, args.baseline_dir)
+        print(f'saved baseline {args.save_baseline!r}')
+
+    if regressed:
+        print('performance regressions detected', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (c) 2019 MagicStack Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+import argparse
+import asyncio
+import sys
+import time
+
+import _utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Save or restore snapshots of the benchmark datasets',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'action',
+        choices=['save', 'restore'],
+        help='save a snapshot of the loaded dataset, or reset the database '
+        'to it',
+    )
+    parser.add_argument(
+        'benchmarks',
+        nargs='+',
+        help='implementations whose databases to snapshot, or "all"',
+        choices=list(_utils.IMPLEMENTATIONS) + ['all'],
+    )
+    parser.add_argument(
+        '--db-host', type=str, default='127.0.0.1',
+        help='host with databases')
+    parser.add_argument(
+        '--pg-port', type=int, default=3500,
+        help='PostgreSQL server port')
+
+    args = parser.parse_args()
+    if 'all' in args.benchmarks:
+        args.benchmarks = list(_utils.IMPLEMENTATIONS)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    for benchname in args.benchmarks:
+        module = _utils.IMPLEMENTATIONS[benchname].module
+        method = getattr(module, f'{args.action}_snapshot', None)
+        if method is None:
+            print(f'{benchname}: snapshots are not supported',
+                  file=sys.stderr)
+            continue
+
+        started_at = time.monotonic()
+        asyncio.run(method(args))
+        print(f'{benchname}: {args.action}d in '
+              f'{time.monotonic() - started_at:.1f} seconds')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import socket
+import statistics
+import threading
+import time
+import unittest
+
+import _netproxy
+
+
+ROUND_TRIPS = 200
+
+# How much later than the configured latency a round trip may take: the
+# loopback and the proxy itself add some tens of microseconds.
+TOLERANCE = 0.5     # ms
+
+
+def echo(conn):
+    with conn:
+        while data := conn.recv(1024):
+            conn.sendall(data)
+
+
+def serve_echo(server):
+    while True:
+        conn, _ = server.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+
+class TestNetProxy(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = socket.create_server(('127.0.0.1', 0))
+        threading.Thread(
+            target=serve_echo, args=(cls.server,), daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def round_trip(self, latency):
+        """Return the median round trip in ms through a proxy adding
+        *latency* ms."""
+        config = _netproxy.NetConfig(
+            latency=latency, jitter=0, distribution='constant',
+            bandwidth=0)
+        proxy = _netproxy.NetProxy(
+            config, {'echo': self.server.getsockname()})
+        port = proxy.start()['echo']
+        try:
+            with socket.create_connection(('127.0.0.1', port)) as conn:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                times = []
+                for _ in range(ROUND_TRIPS):
+                    start = time.monotonic()
+                    conn.sendall(b'x')
+                    self.assertEqual(conn.recv(1024), b'x')
+                    times.append(time.monotonic() - start)
+        finally:
+            proxy.close()
+        return statistics.median(times) * 1000
+
+    def assert_latency(self, latency):
+        rtt = self.round_trip(latency)
+        self.assertGreaterEqual(rtt, latency)
+        self.assertLessEqual(rtt, latency + TOLERANCE)
+
+    def test_half_millisecond(self):
+        self.assert_latency(0.5)
+
+    def test_millisecond(self):
+        self.assert_latency(1)
+
+    def test_milliseconds(self):
+        self.assert_latency(4)
+
+
+if __name__ == '__main__':
+    unittest.main()